@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# rankerV0 with in-memory user tables vs user tables on disk (disk_embedding.diskEmbedding)
+# under Zipfian user traffic: step time, cache hit rate, write-backs, peak and anonymous RSS. Both use
+# row-wise Adagrad for the user tables. Each mode runs in its own process.
+# First checks that the disk tables train exactly like in-memory tables with rowwise-adagrad
+# on the same batches, with a cache small enough to force evictions, that their state_dict()
+# matches the in-memory model's, and that a deepcopy (eval snapshot) does not follow later
+# training steps (exits 1 otherwise).
+# measured (1 core, --users 5000000 --cache-rows 262144 --batch-size 8192 --steps 200): step p50
+# memory 7.6 ms, disk 8.6 ms (hit rate 0.58, 131072 rows evicted and written back); anonymous RSS
+# 1766 MB vs 618 MB. Check: max |memory - disk| 1.5e-8 over 50 steps that evict 15148 rows
+import argparse
+import copy
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from checkpoint import clone_state
+from disk_embedding import diskEmbedding
+from model import create_model
+from sparse_optim import create_optimizer
+from synth_data import zipf_cdf
+
+
+def run(args, mode):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    user_cdf = zipf_cdf(args.users, args.user_zipf)
+    # popularity rank -> table row, so hot rows are spread over the file
+    rank_row = rng.permutation(args.users)
+    user_storage = None
+    if mode == "disk":
+        user_storage = dict(directory=args.disk_dir, cache_rows=args.cache_rows)
+    start = time.perf_counter()
+    model = create_model("rankerV0", args.users, args.creators, args.embedding_dim, sparse=True, user_storage=user_storage)
+    init_seconds = time.perf_counter() - start
+    optimizer = create_optimizer(model, "rowwise-adagrad", 0.01)
+    loss_fn = nn.BCELoss()
+    times = []
+    for step in range(args.warmup + args.steps):
+        u_ind = torch.from_numpy(rank_row[np.searchsorted(user_cdf, rng.random(args.batch_size))])
+        c_ind = torch.randint(0, args.creators, (args.batch_size,))
+        labels = torch.randint(0, 2, (args.batch_size,)).float()
+        start = time.perf_counter()
+        model.zero_grad()
+        loss = loss_fn(model(u_ind, c_ind), labels)
+        loss.backward()
+        optimizer.step()
+        if step >= args.warmup:
+            times.append(time.perf_counter() - start)
+    stats = {}
+    if mode == "disk":
+        stats = model.uemb.cache_stats()
+        model.uemb.flush()
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return mode, init_seconds, float(np.median(times)) * 1000, max_rss_mb, anon_rss_mb(), stats
+
+
+def anon_rss_mb():
+    # resident memory not backed by a file: the rss above also counts the pages of the
+    # memory-mapped tables, which the kernel can drop under memory pressure
+    if not os.path.exists("/proc/self/status"):
+        return float("nan")
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def check_equivalence(args):
+    # small model, cache_rows well below the rows a few batches touch, so every step evicts
+    rows, creators, dim, batch_size = 5000, 500, 16, 512
+    torch.manual_seed(0)
+    memory = create_model("rankerV0", rows, creators, dim, sparse=True)
+    disk = create_model("rankerV0", rows, creators, dim, sparse=True,
+                        user_storage=dict(directory=os.path.join(args.disk_dir, "check"), cache_rows=1500))
+    disk_tables = {name: m for name, m in disk.named_modules() if isinstance(m, diskEmbedding)}
+    disk.load_state_dict(memory.state_dict())
+    optimizers = [create_optimizer(m, "rowwise-adagrad", 0.01) for m in (memory, disk)]
+    loss_fn = nn.BCELoss()
+    rng = np.random.default_rng(0)
+    user_cdf = zipf_cdf(rows, 0.8)
+    consistent = True
+    for step in range(args.check_steps):
+        u_ind = torch.from_numpy(np.searchsorted(user_cdf, rng.random(batch_size)))
+        c_ind = torch.from_numpy(rng.integers(0, creators, batch_size))
+        labels = torch.from_numpy(rng.integers(0, 2, batch_size)).float()
+        for model, optimizer in zip((memory, disk), optimizers):
+            model.zero_grad()
+            loss_fn(model(u_ind, c_ind), labels).backward()
+            optimizer.step()
+        for table in disk_tables.values():
+            occupied = np.flatnonzero(table.slot_row >= 0)
+            consistent = consistent and bool((table.row_slot[table.slot_row[occupied]] == occupied).all())
+            consistent = consistent and int((table.row_slot >= 0).sum()) == len(occupied)
+        if step == args.check_steps // 2:
+            # an eval snapshot must keep these weights while training goes on
+            snapshot, snapshot_state = copy.deepcopy(disk), clone_state(disk.state_dict())
+    stats = {name: t.cache_stats() for name, t in disk_tables.items()}
+    memory_state, disk_state = memory.state_dict(), disk.state_dict()
+    weight_diff = max((memory_state[f"{name}.weight"] - disk_state[f"{name}.weight"]).abs().max().item() for name in disk_tables)
+    dense_diff = max((v - disk_state[k]).abs().max().item() for k, v in memory_state.items()
+                     if k.rsplit(".", 1)[0] not in disk_tables)
+    snapshot_diff = max((v - snapshot_state[k]).abs().max().item() for k, v in snapshot.state_dict().items())
+    same_keys = memory_state.keys() == disk_state.keys()
+    print(f"check: {args.check_steps} steps, evicted {sum(s['evicted'] for s in stats.values())} rows, "
+          f"row <-> slot maps consistent: {consistent}, same state_dict keys: {same_keys}")
+    print(f"check: max |memory - disk| user table {weight_diff:.2e}, dense layers {dense_diff:.2e}, "
+          f"eval snapshot drift {snapshot_diff:.2e}")
+    return consistent and same_keys and max(weight_diff, dense_diff, snapshot_diff) <= args.atol
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50000000)
+    parser.add_argument("--creators", type=int, default=40000)
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--user-zipf", type=float, default=1.05)
+    parser.add_argument("--cache-rows", type=int, default=2**22)
+    parser.add_argument("--disk-dir", default="bench_disk_tables")
+    parser.add_argument("--batch-size", type=int, default=32000)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--modes", nargs="+", default=["memory", "disk"], choices=["memory", "disk"])
+    parser.add_argument("--check-steps", type=int, default=50, help="steps of the memory vs disk equivalence check")
+    parser.add_argument("--atol", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    try:
+        if not check_equivalence(args):
+            print(f"disk tables differ from in-memory tables by more than {args.atol}")
+            sys.exit(1)
+        for mode in args.modes:
+            with ctx.Pool(1) as p:
+                mode, init_seconds, step_ms, max_rss_mb, anon_mb, stats = p.apply(run, (args, mode))
+            line = (f"{mode:6s} init {init_seconds:7.1f}s  step p50 {step_ms:8.1f} ms  max rss {max_rss_mb:9.0f} MB  "
+                    f"anon rss {anon_mb:9.0f} MB")
+            if stats:
+                line += (f"  hit rate {stats['hit_rate']:.4f}  evicted {stats['evicted']}  "
+                         f"written back {stats['written_back']}")
+            print(line)
+    finally:
+        shutil.rmtree(args.disk_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# id -> row lookup throughput: pandas merge (as incr_train.py), registry.idRegistry, and
+# registry.idIndex in memory and memory-mapped from disk. Sparse random int64 ids, Zipfian
+# queries with --oov-fraction unknown ids. Also the idIndex build/save time and load time,
+# and a check that every method returns the same rows (exits 1 otherwise).
+# measured (1 core, 10M ids, 10M Zipf 1.05 queries, 1% oov): pandas merge 6.3M ids/sec,
+# idRegistry / idIndex / idIndex mmap 9.0-9.1M ids/sec (2.8M/s before sorted_search); build+save 1.2s,
+# mmap load 0.3 ms
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from registry import idIndex, idRegistry
+from synth_data import zipf_cdf
+
+
+def timed(fn, repeats):
+    out = fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", type=int, default=10000000)
+    parser.add_argument("--queries", type=int, default=10000000)
+    parser.add_argument("--zipf", type=float, default=1.05)
+    parser.add_argument("--oov-fraction", type=float, default=0.01)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dir", default="bench_id_index")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    ids = rng.choice(args.ids * 8, size=args.ids, replace=False).astype(np.int64) * 3 + 1
+    query = ids[np.searchsorted(zipf_cdf(args.ids, args.zipf), rng.random(args.queries))]
+    oov = rng.random(args.queries) < args.oov_fraction
+    query[oov] = rng.integers(0, args.ids * 24, int(oov.sum())) * 3 + 2
+
+    start = time.perf_counter()
+    index = idIndex.from_ids(ids)
+    os.makedirs(args.dir, exist_ok=True)
+    index.save(args.dir, "user")
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    mapped = idIndex.load(args.dir, "user")
+    load_seconds = time.perf_counter() - start
+    print(f"{args.ids} ids: build+save {build_seconds:.2f}s, mmap load {load_seconds * 1000:.2f} ms, "
+          f"{(index.keys.nbytes + index.rows.nbytes) / 2**20:.0f} MB on disk")
+
+    id_frame = pd.DataFrame({"id": ids, "row": np.arange(len(ids))})
+
+    def pandas_merge():
+        merged = pd.DataFrame({"id": query}).merge(id_frame, on="id", how="left")
+        return merged["row"].fillna(-1).to_numpy(dtype=np.int64)
+
+    registry = idRegistry(ids)
+    methods = [("pandas merge", pandas_merge), ("idRegistry", lambda: registry.lookup(query)),
+               ("idIndex", lambda: index.lookup(query)), ("idIndex mmap", lambda: mapped.lookup(query))]
+    reference = None
+    ok = True
+    for name, fn in methods:
+        rows, seconds = timed(fn, args.repeats)
+        rows = np.asarray(rows, dtype=np.int64)
+        if reference is None:
+            reference = rows
+        same = np.array_equal(rows, reference)
+        ok = ok and same
+        print(f"{name:14s} {args.queries / seconds / 1e6:8.1f}M ids/sec  same rows: {same}")
+    print(f"oov queries: {int((reference < 0).sum())}")
+    shutil.rmtree(args.dir, ignore_errors=True)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# binnedMetrics vs sklearn on random scores: absolute differences and the reported AUC error bound
+import argparse
+import time
+
+import numpy as np
+from sklearn.metrics import average_precision_score, log_loss, roc_auc_score
+
+from metrics import binnedMetrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--bins", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=524280)
+    parser.add_argument("--workers", type=int, default=4, help="split the rows into this many accumulators and merge them")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    logits = rng.normal(-1.0, 1.5, args.rows)
+    labels = (rng.random(args.rows) < 1 / (1 + np.exp(-logits))).astype(np.float32)
+    preds = (1 / (1 + np.exp(-(logits + rng.normal(0, 1.0, args.rows))))).astype(np.float32)
+
+    start = time.perf_counter()
+    parts = []
+    for shard in np.array_split(np.arange(args.rows), args.workers):
+        m = binnedMetrics(args.bins)
+        for i in range(0, len(shard), args.batch_size):
+            idx = shard[i:i + args.batch_size]
+            m.update(preds[idx], labels[idx])
+        parts.append(m)
+    merged = parts[0]
+    for m in parts[1:]:
+        merged.merge(m)
+    elapsed = time.perf_counter() - start
+
+    auc = roc_auc_score(labels, preds)
+    ap = average_precision_score(labels, preds)
+    ll = log_loss(labels, preds.astype(np.float64))
+    print(f"rows={args.rows} bins={args.bins} workers={args.workers} update+merge={elapsed:.2f}s")
+    print(f"auc:      sklearn={auc:.6f} binned={merged.roc_auc():.6f} |diff|={abs(auc - merged.roc_auc()):.2e} bound={merged.auc_error_bound():.2e}")
+    print(f"pr-auc:   sklearn={ap:.6f} binned={merged.pr_auc():.6f} |diff|={abs(ap - merged.pr_auc()):.2e}")
+    print(f"log-loss: sklearn={ll:.6f} binned={merged.log_loss():.6f} |diff|={abs(ll - merged.log_loss()):.2e}")
+
+
+if __name__ == "__main__":
+    main()
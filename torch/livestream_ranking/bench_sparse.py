@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# step time and peak RSS of one ranker under the dense Adam path vs the sparse-gradient optimizers.
+# Each optimizer runs in its own process so ru_maxrss is per mode.
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+import torch.nn as nn
+
+from model import create_model
+from sparse_optim import create_optimizer, OPTIMIZERS
+
+
+def run(args, optimizer_name):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = create_model(args.model_type, args.users, args.creators, args.embedding_dim, sparse=optimizer_name != "adam")
+    optimizer = create_optimizer(model, optimizer_name, 0.01)
+    loss_fn = nn.BCELoss()
+    times = []
+    for step in range(args.warmup + args.steps):
+        u_ind = torch.randint(0, args.users, (args.batch_size,))
+        c_ind = torch.randint(0, args.creators, (args.batch_size,))
+        labels = torch.randint(0, 2, (args.batch_size,)).float()
+        start = time.perf_counter()
+        model.zero_grad()
+        loss = loss_fn(model(u_ind, c_ind), labels)
+        loss.backward()
+        optimizer.step()
+        if step >= args.warmup:
+            times.append(time.perf_counter() - start)
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return optimizer_name, sum(times) / len(times), max_rss_mb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-type", default="rankerV0")
+    parser.add_argument("--users", type=int, default=10000000)
+    parser.add_argument("--creators", type=int, default=40000)
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=32000)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    for name in OPTIMIZERS:
+        with ctx.Pool(1) as p:
+            name, step_time, max_rss_mb = p.apply(run, (args, name))
+        print(f"{args.model_type} {name:16s} step {step_time * 1000:8.1f} ms  max rss {max_rss_mb:9.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# catalogScorer throughput for users x creators, checked against model(u_ind, c_ind) on the full matrix
+import argparse
+import time
+
+import torch
+
+from model import create_model
+from topk import catalogScorer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-type", default="rankerV0", choices=["rankerOld", "rankerV0"])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--creators", type=int, default=40000)
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--allowed-fraction", type=float, default=1.0, help="share of creators in the allow-list")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = create_model(args.model_type, args.users, args.creators, args.embedding_dim)
+    if hasattr(model, "user_bias"):
+        torch.nn.init.normal_(model.user_bias.weight, std=0.01)
+        torch.nn.init.normal_(model.creator_bias.weight, std=0.01)
+    model.eval()
+    allowed = None
+    if args.allowed_fraction < 1.0:
+        allowed = torch.randperm(args.creators)[:int(args.creators * args.allowed_fraction)].sort().values
+    scorer = catalogScorer(model, allowed, chunk_size=args.chunk_size)
+    users = torch.arange(args.users)
+
+    scorer.topk(users, args.k)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        scores, rows = scorer.topk(users, args.k)
+    elapsed = (time.perf_counter() - start) / args.repeats
+    n_catalog = len(scorer.creator_rows)
+    print(f"{args.model_type} {args.users} users x {n_catalog} creators, k={args.k}: {elapsed * 1000:.1f} ms, "
+          f"{args.users / elapsed:.0f} users/sec, {args.users * n_catalog / elapsed / 1e6:.1f}M scores/sec")
+
+    # reference: every pair through the model's own forward, a few users at a time
+    ref_scores = []
+    with torch.no_grad():
+        for batch in users.split(32):
+            u_ind = batch.repeat_interleave(n_catalog)
+            c_ind = scorer.creator_rows.repeat(len(batch))
+            full = model(u_ind, c_ind).view(len(batch), n_catalog)
+            ref_scores.append(torch.topk(full, scores.shape[1], dim=1).values)
+    ref_scores = torch.cat(ref_scores)
+    print(f"max |topk score - model score|: {(ref_scores - scores).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import queue
+import re
+import threading
+
+import torch
+
+
+def clone_state(obj):
+    # copy of a (nested) state dict with every tensor cloned, so training can keep
+    # updating the live tensors while the copy is written out
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: clone_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_state(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # torch.save into a temp file next to path, fsync, then rename over path:
+    # readers see either the old file or the complete new one, never a partial write
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def checkpoint_paths(directory, prefix="ckpt"):
+    # training checkpoints in directory, oldest first
+    if not os.path.isdir(directory):
+        return []
+    pattern = re.compile(rf"^{re.escape(prefix)}_(\d+)_(\d+)\.pt$")
+    found = []
+    for name in os.listdir(directory):
+        m = pattern.match(name)
+        if m:
+            found.append(((int(m.group(1)), int(m.group(2))), os.path.join(directory, name)))
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(directory, prefix="ckpt"):
+    paths = checkpoint_paths(directory, prefix)
+    return paths[-1] if paths else None
+
+
+def load_training_state(path):
+    # -> dict(model, optimizer, epoch, step, ...) as written by checkpointWriter.checkpoint
+    return torch.load(path, map_location="cpu")
+
+
+class checkpointWriter:
+    # Writes checkpoints from a background thread. The training loop only pays for copying
+    # the tensors into a snapshot (a memcpy of the tables); serialization and disk I/O happen
+    # off the step loop. At most one snapshot is pending: a new save waits for the previous
+    # write to finish first, so memory is bounded by one extra copy of the model + optimizer.
+    # Every file is written with atomic_save; checkpoint() keeps only the newest `keep` files.
+    def __init__(self, directory, prefix="ckpt", keep=3):
+        assert keep >= 1
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.requests = queue.Queue(maxsize=1)
+        self.error = None
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path):
+        # write state (already a snapshot, see clone_state) to path in the background
+        self.wait()
+        self.idle.clear()
+        self.requests.put((state, path, False))
+
+    def checkpoint(self, model, optimizer, epoch, step, **extra):
+        # full training state to <directory>/<prefix>_<epoch>_<step>.pt; `step` is the number
+        # of steps done in `epoch`, extra holds whatever else resuming needs (rng states, ...)
+        self.wait()
+        state = {
+            "model": clone_state(model.state_dict()),
+            "optimizer": clone_state(optimizer.state_dict()),
+            "epoch": epoch,
+            "step": step,
+        }
+        state.update(extra)
+        path = os.path.join(self.directory, f"{self.prefix}_{epoch:04d}_{step:08d}.pt")
+        self.idle.clear()
+        self.requests.put((state, path, True))
+        return path
+
+    def wait(self):
+        self.idle.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            state, path, rotate = request
+            try:
+                atomic_save(state, path)
+                if rotate:
+                    for old in checkpoint_paths(self.directory, self.prefix)[:-self.keep]:
+                        os.remove(old)
+            except BaseException as e:
+                self.error = e
+            finally:
+                del state, request
+                self.idle.set()
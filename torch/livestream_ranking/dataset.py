@@ -1,30 +1,201 @@
+import hashlib
+import json
 import os
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
 import pandas as pd
 
-def read_df(data_directory):
-    df_list = []
+VAL_DATE = "2023-04-03"
+GAP_DATE = "2023-04-02"
+MAX_USER_INDEX = 10000000
 
-    for i in os.listdir(data_directory):
-        dfs = pd.read_csv(data_directory + "/" + i)
-        df_list.append(dfs)
+# only these columns are parsed, with explicit dtypes; everything else in the csv is skipped
+CSV_DTYPES = {
+    "memberId": "int64",
+    "hostId": "int64",
+    "interaction_date": "category",
+    "total_timespent": "float64",
+}
+VAL_CATEGORIES = ["0", "1", "2"]
+# bump when the cached layout or the preprocessing above changes
+CACHE_VERSION = 1
+CACHE_COLUMNS = ["userIndex", "creatorIndex", "label", "val"]
+# "ngroup": userIndex is the dense 0..n_user-1 index (capped at max_user_index, default MAX_USER_INDEX)
+# "id":     userIndex is the raw userId, for models with hashed user tables (model.compositionalEmbedding)
+USER_INDEX_MODES = ["ngroup", "id"]
 
-    main_df = pd.concat(df_list).reset_index(drop=True)
-    main_df.rename(columns={'hostId': 'creatorId', 'memberId': 'userId'}, inplace=True)
-    return main_df
 
-def create_dataset(data_directory):
-    main_df = read_df(data_directory)
-    # 2023-04-03
-    main_df["val"] = "0"
-    main_df.loc[main_df["interaction_date"] == "2023-04-03", "val"] = "1"
-    main_df.loc[main_df["interaction_date"] == "2023-04-02", "val"] = "2"
+def read_file(path, val_date=VAL_DATE, gap_date=GAP_DATE):
+    # runs in a worker: parses one csv and reduces it to the compact per-row columns,
+    # so raw date strings and timespent never reach the concatenated frame
+    df = pd.read_csv(path, usecols=list(CSV_DTYPES), dtype=CSV_DTYPES)
+    date = df["interaction_date"]
+    val = np.zeros(len(df), dtype=np.int8)
+    val[(date == val_date).to_numpy()] = 1
+    val[(date == gap_date).to_numpy()] = 2
+    return pd.DataFrame({
+        "userId": df["memberId"].to_numpy(),
+        "creatorId": df["hostId"].to_numpy(),
+        "val": pd.Categorical.from_codes(val, categories=VAL_CATEGORIES),
+        "label": (df["total_timespent"].to_numpy() * 60 >= 60).astype(np.int8),
+    })
+
+
+def read_df(data_directory, val_date=VAL_DATE, gap_date=GAP_DATE, n_workers=None):
+    files = [os.path.join(data_directory, i) for i in sorted(os.listdir(data_directory))]
+    with Pool(n_workers) as p:
+        df_list = p.map(partial(read_file, val_date=val_date, gap_date=gap_date), files)
+    return pd.concat(df_list, ignore_index=True)
+
+
+def input_files(data_directory):
+    # [name, size, mtime] of every file in data_directory: changes when a file is added, removed or rewritten
+    files = []
+    for i in sorted(os.listdir(data_directory)):
+        st = os.stat(os.path.join(data_directory, i))
+        files.append([i, st.st_size, st.st_mtime_ns])
+    return files
+
+
+def cache_key(data_directory, val_date, gap_date, user_index="ngroup", max_user_index=MAX_USER_INDEX):
+    # any added/removed/rewritten input file changes the key, which is what invalidates the cache
+    key = cache_mode(val_date, gap_date, user_index, max_user_index) + [input_files(data_directory)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+
+def cache_mode(val_date, gap_date, user_index="ngroup", max_user_index=MAX_USER_INDEX):
+    # everything in the cache key except the input files: one cache entry is kept per mode
+    return [CACHE_VERSION, max_user_index, val_date, gap_date, user_index]
+
+
+def default_cache_dir(data_directory):
+    # next to the input directory, not inside it: read_df reads every file in data_directory
+    return os.path.normpath(data_directory) + "_cache"
+
+
+def id_maps(main_df, user_index="ngroup"):
+    # sorted id arrays where position == index, i.e. user_ids[userIndex] == userId.
+    # with user_index="id" there is no user index, user_ids is just the sorted distinct userIds
+    if user_index == "id":
+        user_ids = np.unique(main_df["userId"].to_numpy())
+    else:
+        user_ids = np.empty(main_df["userIndex"].max() + 1, dtype=main_df["userId"].dtype)
+        user_ids[main_df["userIndex"].to_numpy()] = main_df["userId"].to_numpy()
+    creator_ids = np.empty(main_df["creatorIndex"].max() + 1, dtype=main_df["creatorId"].dtype)
+    creator_ids[main_df["creatorIndex"].to_numpy()] = main_df["creatorId"].to_numpy()
+    return user_ids, creator_ids
+
+
+def write_cache(main_df, cache_dir, key, user_index="ngroup", mode=None):
+    # columns as .npy so they can be memory-mapped back, plus the id_maps arrays and the
+    # entry's cache_mode (mode.json)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = os.path.join(cache_dir, f".{key}.tmp.{os.getpid()}")
+    os.makedirs(tmp_dir)
+    for col in CACHE_COLUMNS:
+        if col == "val":
+            arr = main_df[col].cat.codes.to_numpy()
+        else:
+            arr = main_df[col].to_numpy()
+        np.save(os.path.join(tmp_dir, f"{col}.npy"), arr)
+    user_ids, creator_ids = id_maps(main_df, user_index)
+    np.save(os.path.join(tmp_dir, "user_ids.npy"), user_ids)
+    np.save(os.path.join(tmp_dir, "creator_ids.npy"), creator_ids)
+    with open(os.path.join(tmp_dir, "mode.json"), "w") as f:
+        json.dump(mode, f)
+    # atomic publish; another process may have published the same key meanwhile
+    try:
+        os.rename(tmp_dir, os.path.join(cache_dir, key))
+    except OSError:
+        if not os.path.isdir(os.path.join(cache_dir, key)):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    # drop finished entries of the same mode built from older versions of the input; entries of
+    # other modes (--user-hash, --user-disk-dir runs) and in-progress .tmp dirs of other writers stay
+    for i in os.listdir(cache_dir):
+        if i == key or i.startswith("."):
+            continue
+        try:
+            with open(os.path.join(cache_dir, i, "mode.json")) as f:
+                entry_mode = json.load(f)
+        except (OSError, ValueError):
+            entry_mode = None
+        if entry_mode is None or entry_mode == mode:
+            shutil.rmtree(os.path.join(cache_dir, i), ignore_errors=True)
+
+
+def load_cache(cache_dir, key, mmap_mode="r", shard=None, user_index="ngroup"):
+    # shard=(rank, world_size) keeps every world_size-th train row plus all val/gap rows;
+    # with mmap_mode only the pages of the selected rows are read
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    cols = {col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode=mmap_mode) for col in CACHE_COLUMNS}
+    if shard is not None:
+        rank, world_size = shard
+        keep = np.asarray(cols["val"]) != 0
+        keep[rank::world_size] = True
+        rows = np.flatnonzero(keep)
+        cols = {col: arr[rows] for col, arr in cols.items()}
+    user_ids = np.load(os.path.join(path, "user_ids.npy"), mmap_mode=mmap_mode)
+    creator_ids = np.load(os.path.join(path, "creator_ids.npy"), mmap_mode=mmap_mode)
+    return pd.DataFrame({
+        "userId": cols["userIndex"] if user_index == "id" else user_ids[cols["userIndex"]],
+        "creatorId": creator_ids[cols["creatorIndex"]],
+        "val": pd.Categorical.from_codes(cols["val"], categories=VAL_CATEGORIES),
+        "label": cols["label"],
+        "userIndex": cols["userIndex"],
+        "creatorIndex": cols["creatorIndex"],
+    })
+
+
+def prepare_cache(data_directory, val_date=VAL_DATE, gap_date=GAP_DATE, n_workers=None, cache_dir=None, user_index="ngroup",
+                  max_user_index=MAX_USER_INDEX):
+    # builds the cache for the current input files if it is missing; returns (cache_dir, key)
+    cache_dir = cache_dir or default_cache_dir(data_directory)
+    key = cache_key(data_directory, val_date, gap_date, user_index, max_user_index)
+    if not os.path.isdir(os.path.join(cache_dir, key)):
+        create_dataset(data_directory, val_date, gap_date, n_workers, cache_dir, user_index=user_index,
+                       max_user_index=max_user_index)
+    return cache_dir, key
+
+
+def load_id_maps(cache_dir, key, mmap_mode="r"):
+    # userId -> userIndex / creatorId -> creatorIndex as sorted id arrays (lookup with np.searchsorted)
+    path = os.path.join(cache_dir, key)
+    return (np.load(os.path.join(path, "user_ids.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "creator_ids.npy"), mmap_mode=mmap_mode))
+
+
+def create_dataset(data_directory, val_date=VAL_DATE, gap_date=GAP_DATE, n_workers=None, cache_dir=None, use_cache=True,
+                   user_index="ngroup", max_user_index=MAX_USER_INDEX):
+    # max_user_index=None keeps every user (e.g. for user tables on disk, model.user_table)
+    assert user_index in USER_INDEX_MODES
+    if use_cache:
+        cache_dir = cache_dir or default_cache_dir(data_directory)
+        key = cache_key(data_directory, val_date, gap_date, user_index, max_user_index)
+        main_df = load_cache(cache_dir, key, user_index=user_index)
+        if main_df is not None:
+            print(f"loaded dataset from cache {cache_dir}/{key}")
+            print(f"n_user: {main_df['userIndex'].max()}, n_creator: {main_df['creatorIndex'].max()}")
+            return main_df
+    main_df = read_df(data_directory, val_date, gap_date, n_workers)
     print("train df shape: ", main_df[main_df["val"] == "0"].shape)
     print("val df shape: ", main_df[main_df["val"] == "1"].shape)
     print("gap df shape: ", main_df[main_df["val"] == "2"].shape)
 
-    main_df['userIndex'] = main_df.groupby('userId').ngroup()
-    main_df = main_df[main_df['userIndex'] <= 10000000]
-    main_df['creatorIndex'] = main_df.groupby('creatorId').ngroup()
-    main_df['label'] = main_df['total_timespent'].apply(lambda x: 1 if x*60>=60 else 0)
-    print(f"n_user: {max(main_df['userIndex'])}, n_creator: {max(main_df['creatorIndex'])}")
-    return main_df
\ No newline at end of file
+    # factorize(sort=True) gives the same indices as groupby().ngroup()
+    if user_index == "id":
+        main_df["userIndex"] = main_df["userId"]
+    else:
+        main_df["userIndex"] = pd.factorize(main_df["userId"], sort=True)[0].astype(np.int32)
+        if max_user_index is not None:
+            main_df = main_df[main_df["userIndex"] <= max_user_index].reset_index(drop=True)
+    main_df["creatorIndex"] = pd.factorize(main_df["creatorId"], sort=True)[0].astype(np.int32)
+    print(f"n_user: {main_df['userIndex'].max()}, n_creator: {main_df['creatorIndex'].max()}")
+    if use_cache:
+        write_cache(main_df, cache_dir, key, user_index, cache_mode(val_date, gap_date, user_index, max_user_index))
+    return main_df
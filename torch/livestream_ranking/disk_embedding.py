@@ -0,0 +1,268 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class diskEmbedding(nn.Module):
+    # Embedding table + row-wise Adagrad state kept in memory-mapped .npy files
+    # (<path>.weight.npy, <path>.state.npy), with a bounded in-memory cache of cache_rows rows.
+    # RAM is cache_rows * (dim + 1) floats plus a 4-byte row -> cache slot map per table row,
+    # so the table itself is limited by disk only.
+    #
+    # forward() (training) looks the batch's unique rows up in the cache; misses are read from
+    # the file into free slots. When the cache is full the least recently used 1/16 of it
+    # (never rows of the current batch) is evicted at once, and its dirty rows are handed to a
+    # background thread that writes them back to the file. Rows being written back are not
+    # read from the file until the write is done. The gathered rows are one leaf tensor
+    # whose gradient diskTableOptimizer (via sparse_optim.create_optimizer) applies to the
+    # cache with row-wise Adagrad, so there is no nn.Parameter for this table and the
+    # optimizer state lives with the rows. One training forward per optimizer step.
+    # On popular-item (Zipfian) traffic almost all lookups hit the cache.
+    #
+    # Evaluation (eval mode or no_grad) reads cached rows from the cache and the rest from the
+    # file without inserting them, so validation does not flush the training working set.
+    # .weight flushes the cache and returns the whole table as a tensor over the mmap; the
+    # rankers' init lines initialise the file through it. state_dict() holds it as "weight"
+    # (torch.save streams it from the file), and load_state_dict() copies a "weight" into the
+    # file, so saved models have the same keys as with an nn.Embedding table.
+    # A deepcopy (e.g. asyncEvaluator's snapshot) is an eval-only table in its own
+    # <path>.snapshot.*.npy files holding a copy of the weights; loading a state dict into it
+    # copies the table file again. Files are created fresh: existing table files are only
+    # replaced with overwrite=True, so a finished run's tables are not wiped by the next one.
+    def __init__(self, path, n_rows, embedding_dim, cache_rows=2**20, eps=1e-10, overwrite=False):
+        super(diskEmbedding, self).__init__()
+        if not overwrite and os.path.exists(f"{path}.weight.npy"):
+            raise FileExistsError(f"{path}.weight.npy already exists; remove it to train a new table there")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.n_rows = n_rows
+        self.embedding_dim = embedding_dim
+        self.cache_rows = min(cache_rows, n_rows)
+        self.eps = eps
+        self.storage = np.lib.format.open_memmap(f"{path}.weight.npy", mode="w+", dtype=np.float32,
+                                                 shape=(n_rows, embedding_dim))
+        self.state_storage = np.lib.format.open_memmap(f"{path}.state.npy", mode="w+", dtype=np.float32, shape=(n_rows,))
+        self.cache_weight = torch.zeros(self.cache_rows, embedding_dim)
+        self.cache_state = torch.zeros(self.cache_rows)
+        self.slot_row = np.full(self.cache_rows, -1, dtype=np.int64)
+        self.row_slot = np.full(n_rows, -1, dtype=np.int32)
+        self.last_used = np.zeros(self.cache_rows, dtype=np.int64)
+        self.dirty = np.zeros(self.cache_rows, dtype=bool)
+        self.free = np.arange(self.cache_rows, dtype=np.int64)[::-1].copy()
+        self.n_free = self.cache_rows
+        self.clock = 0
+        self.pending = []
+        self.stats = {"lookups": 0, "misses": 0, "evicted": 0, "written_back": 0}
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.writeback = queue.Queue(maxsize=8)
+        self.writer = threading.Thread(target=self._write_back, daemon=True)
+        self.writer.start()
+
+    def __deepcopy__(self, memo):
+        snapshot = diskEmbedding(f"{self.path}.snapshot", self.n_rows, self.embedding_dim, cache_rows=1,
+                                 eps=self.eps, overwrite=True)
+        snapshot.load_weight(self.weight)
+        snapshot.train(self.training)
+        memo[id(self)] = snapshot
+        return snapshot
+
+    @property
+    def weight(self):
+        self.flush()
+        return torch.from_numpy(self.storage)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        destination[prefix + "weight"] = self.weight
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        key = prefix + "weight"
+        if key not in state_dict:
+            missing_keys.append(key)
+            return
+        weight = state_dict[key]
+        if tuple(weight.shape) != (self.n_rows, self.embedding_dim):
+            error_msgs.append(f"size mismatch for {key}: copying a param with shape {tuple(weight.shape)}, "
+                              f"the shape in current model is {(self.n_rows, self.embedding_dim)}")
+            return
+        self.load_weight(weight)
+
+    @torch.no_grad()
+    def load_weight(self, weight, chunk_rows=1 << 20):
+        # replace the whole table (not the Adagrad state); the cached rows are dropped unwritten
+        with self.lock:
+            self.writeback.join()
+            self.slot_row[:] = -1
+            self.row_slot[:] = -1
+            self.dirty[:] = False
+            self.last_used[:] = 0
+            self.free = np.arange(self.cache_rows, dtype=np.int64)[::-1].copy()
+            self.n_free = self.cache_rows
+            self.pending = []
+            for start in range(0, self.n_rows, chunk_rows):
+                self.storage[start:start + chunk_rows] = weight[start:start + chunk_rows].detach().cpu().numpy()
+            self.storage.flush()
+
+    def forward(self, ids):
+        flat = ids.reshape(-1)
+        rows, inverse = torch.unique(flat, return_inverse=True)
+        rows_np = rows.numpy()
+        with self.lock:
+            if self.training and torch.is_grad_enabled():
+                # rows of a forward that never reached step() may be evicted below
+                self.pending = []
+                slots = self._cache_slots(rows_np)
+                gathered = self.cache_weight[torch.from_numpy(slots)].requires_grad_(True)
+                self.pending.append((slots, gathered))
+            else:
+                gathered = self._read_rows(rows_np)
+        return gathered[inverse].view(*ids.shape, self.embedding_dim)
+
+    def _cache_slots(self, rows):
+        # cache slot of every row, loading the misses (rows are unique)
+        assert len(rows) <= self.cache_rows, "cache_rows is smaller than the unique rows of one batch"
+        self.clock += 1
+        slots = self.row_slot[rows].astype(np.int64)
+        miss = slots < 0
+        self.last_used[slots[~miss]] = self.clock
+        n_miss = int(miss.sum())
+        if n_miss:
+            missed = rows[miss]
+            new_slots = self._allocate(n_miss)
+            self._wait_written(missed)
+            self.cache_weight[torch.from_numpy(new_slots)] = torch.from_numpy(self.storage[missed])
+            self.cache_state[torch.from_numpy(new_slots)] = torch.from_numpy(self.state_storage[missed])
+            self.slot_row[new_slots] = missed
+            self.row_slot[missed] = new_slots
+            self.dirty[new_slots] = False
+            self.last_used[new_slots] = self.clock
+            slots[miss] = new_slots
+        self.stats["lookups"] += len(rows)
+        self.stats["misses"] += n_miss
+        return slots
+
+    def _read_rows(self, rows):
+        slots = self.row_slot[rows]
+        hit = slots >= 0
+        out = torch.empty(len(rows), self.embedding_dim)
+        out[torch.from_numpy(hit)] = self.cache_weight[torch.from_numpy(slots[hit].astype(np.int64))]
+        missed = rows[~hit]
+        self._wait_written(missed)
+        out[torch.from_numpy(~hit)] = torch.from_numpy(self.storage[missed])
+        return out
+
+    def _allocate(self, n):
+        if self.n_free < n:
+            # bulk LRU eviction among the occupied slots; slots of the current batch
+            # (last_used == clock) and free slots are never chosen
+            candidates = np.flatnonzero((self.slot_row >= 0) & (self.last_used != self.clock))
+            n_evict = min(max(n - self.n_free, self.cache_rows // 16), len(candidates))
+            oldest = np.argpartition(self.last_used[candidates], n_evict - 1)[:n_evict]
+            self._evict(candidates[oldest])
+        self.n_free -= n
+        return self.free[self.n_free:self.n_free + n].copy()
+
+    def _evict(self, slots):
+        rows = self.slot_row[slots]
+        dirty = self.dirty[slots]
+        if dirty.any():
+            self._queue_write(rows[dirty], slots[dirty])
+        self.row_slot[rows] = -1
+        self.slot_row[slots] = -1
+        self.dirty[slots] = False
+        self.last_used[slots] = 0
+        self.free[self.n_free:self.n_free + len(slots)] = slots
+        self.n_free += len(slots)
+        self.stats["evicted"] += len(slots)
+
+    def _queue_write(self, rows, slots):
+        order = np.argsort(rows)
+        rows, slots = rows[order], slots[order]
+        t_slots = torch.from_numpy(slots)
+        item = (rows, self.cache_weight[t_slots].numpy(), self.cache_state[t_slots].numpy())
+        with self.inflight_lock:
+            self.inflight[id(item)] = rows
+        self.writeback.put(item)
+        self.stats["written_back"] += len(rows)
+
+    def _wait_written(self, rows):
+        with self.inflight_lock:
+            inflight = list(self.inflight.values())
+        if inflight and np.isin(rows, np.concatenate(inflight)).any():
+            self.writeback.join()
+
+    def _write_back(self):
+        while True:
+            item = self.writeback.get()
+            if item is None:
+                self.writeback.task_done()
+                return
+            rows, values, states = item
+            self.storage[rows] = values
+            self.state_storage[rows] = states
+            with self.inflight_lock:
+                del self.inflight[id(item)]
+            self.writeback.task_done()
+
+    @torch.no_grad()
+    def apply_gradients(self, lr):
+        # row-wise Adagrad (as sparse_optim.rowWiseAdagrad) on the rows of every forward since the last call
+        with self.lock:
+            for slots, gathered in self.pending:
+                if gathered.grad is None:
+                    continue
+                t_slots = torch.from_numpy(slots)
+                grad = gathered.grad
+                state = self.cache_state[t_slots] + grad.pow(2).mean(dim=1)
+                self.cache_state[t_slots] = state
+                self.cache_weight[t_slots] -= lr * grad / (state.sqrt() + self.eps).unsqueeze(1)
+                self.dirty[slots] = True
+            self.pending = []
+
+    def clear_pending(self):
+        self.pending = []
+
+    def flush(self):
+        # write every dirty cached row to the files and wait for the background writes
+        with self.lock:
+            self.writeback.join()
+            slots = np.flatnonzero(self.dirty)
+            if len(slots):
+                rows = self.slot_row[slots]
+                t_slots = torch.from_numpy(slots)
+                self.storage[rows] = self.cache_weight[t_slots].numpy()
+                self.state_storage[rows] = self.cache_state[t_slots].numpy()
+                self.dirty[slots] = False
+            self.storage.flush()
+            self.state_storage.flush()
+
+    def cache_stats(self):
+        lookups = max(self.stats["lookups"], 1)
+        return dict(self.stats, hit_rate=1 - self.stats["misses"] / lookups, cached=self.cache_rows - self.n_free)
+
+
+class diskTableOptimizer:
+    # optimizer interface (step / zero_grad / state_dict) for the diskEmbedding tables of a
+    # model; their optimizer state is in the table files, so state_dict() is empty
+    def __init__(self, tables, lr=0.01):
+        self.tables = tables
+        self.lr = lr
+
+    def zero_grad(self, set_to_none=True):
+        for t in self.tables:
+            t.clear_pending()
+
+    def step(self):
+        for t in self.tables:
+            t.apply_gradients(self.lr)
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
@@ -0,0 +1,62 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_process_group(rank, world_size, port=29500):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+
+def min_across_ranks(value):
+    t = torch.tensor([value], dtype=torch.int64)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return int(t.item())
+
+
+def all_gather_objects(obj):
+    # [obj of rank 0, obj of rank 1, ...] on every rank (small picklable objects only)
+    out = [None] * dist.get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def all_gather_rows(indices, values):
+    # variable-length all_gather: pad to the longest rank, gather, trim.
+    # Concatenation is in rank order, so every rank ends up with identical tensors
+    world_size = dist.get_world_size()
+    n = torch.tensor([len(indices)], dtype=torch.int64)
+    sizes = [torch.zeros_like(n) for _ in range(world_size)]
+    dist.all_gather(sizes, n)
+    sizes = [int(s.item()) for s in sizes]
+    max_n = max(sizes)
+    padded_indices = torch.zeros(max_n, dtype=indices.dtype)
+    padded_indices[:len(indices)] = indices
+    padded_values = torch.zeros((max_n,) + tuple(values.shape[1:]), dtype=values.dtype)
+    padded_values[:len(values)] = values
+    gathered_indices = [torch.empty_like(padded_indices) for _ in range(world_size)]
+    gathered_values = [torch.empty_like(padded_values) for _ in range(world_size)]
+    dist.all_gather(gathered_indices, padded_indices)
+    dist.all_gather(gathered_values, padded_values)
+    return (torch.cat([g[:s] for g, s in zip(gathered_indices, sizes)]),
+            torch.cat([g[:s] for g, s in zip(gathered_values, sizes)]))
+
+
+@torch.no_grad()
+def average_gradients(model):
+    # Sparse embedding gradients are exchanged as (row ids, row values) of the rows each rank
+    # touched, so traffic scales with the batch, not with the 10M-row table. Dense gradients
+    # (MLP / attention / dense embeddings) are all-reduced as usual.
+    world_size = dist.get_world_size()
+    for p in model.parameters():
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            grad = p.grad.coalesce()
+            rows, values = all_gather_rows(grad._indices()[0], grad._values())
+            p.grad = torch.sparse_coo_tensor(rows.unsqueeze(0), values / world_size, grad.shape).coalesce()
+        else:
+            dist.all_reduce(p.grad)
+            p.grad.div_(world_size)
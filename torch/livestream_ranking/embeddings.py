@@ -0,0 +1,223 @@
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from dataset import input_files
+from disk_embedding import diskEmbedding
+from registry import idIndex
+
+# embedding/bias tables of the rankers, by which id space indexes their rows
+USER_TABLES = ["uemb", "user_bias", "user_embedding"]
+CREATOR_TABLES = ["cemb", "creator_bias", "creator_embedding"]
+
+
+def model_tables(model, user_ids=None):
+    # {table name: float32 numpy view of the weight} for every embedding table the model has.
+    # hashed user tables (model.compositionalEmbedding) have no row per user; given user_ids
+    # (the raw ids the model was trained on) they are materialized as one row per user, so
+    # the export has the same layout as for an exact table, otherwise they are skipped
+    tables = {}
+    for name in USER_TABLES + CREATOR_TABLES:
+        module = getattr(model, name, None)
+        if isinstance(module, (nn.Embedding, diskEmbedding)):
+            # for a diskEmbedding: flushed, and a view of its memory-mapped file
+            tables[name] = module.weight.detach().cpu().numpy()
+        elif module is not None and user_ids is not None and name in USER_TABLES:
+            with torch.no_grad():
+                tables[name] = module(torch.as_tensor(np.asarray(user_ids), dtype=torch.int64)).cpu().numpy()
+    return tables
+
+
+def write_store(out_dir, tables, user_ids, creator_ids, model_name, source=None):
+    # Layout of out_dir:
+    #   <table>.npy       float32 [rows, dim] per embedding table, loadable with mmap_mode="r"
+    #   user_ids.npy      ids of the user tables, row i <-> user_ids[i]
+    #   creator_ids.npy   same for the creator tables
+    #   user_index.*.npy, creator_index.*.npy   registry.idIndex over the ids, for id -> row at serving time
+    #   meta.json         model name, timestamp, the shape of every table and `source`, what the
+    #                     tables were built from (e.g. the input files, see pretrained_store_current)
+    # written into a temp dir and renamed into place (publish_dir), so readers never see a partial export
+    tmp_dir = f"{os.path.normpath(out_dir)}.tmp.{os.getpid()}"
+    os.makedirs(tmp_dir)
+    meta = {
+        "model_name": model_name,
+        "time": datetime.datetime.now().isoformat(),
+        "tables": {},
+        "source": source,
+    }
+    for name, weight in tables.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(weight, dtype=np.float32))
+        meta["tables"][name] = {
+            "rows": weight.shape[0],
+            "dim": weight.shape[1],
+            "ids": "user" if name in USER_TABLES else "creator",
+        }
+    np.save(os.path.join(tmp_dir, "user_ids.npy"), np.asarray(user_ids))
+    np.save(os.path.join(tmp_dir, "creator_ids.npy"), np.asarray(creator_ids))
+    idIndex.from_ids(user_ids).save(tmp_dir, "user")
+    idIndex.from_ids(creator_ids).save(tmp_dir, "creator")
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    publish_dir(tmp_dir, out_dir)
+    return meta
+
+
+def publish_dir(tmp_dir, out_dir):
+    # replaces out_dir by the finished tmp_dir: the old directory is renamed aside before the
+    # new one is renamed in and only deleted after, so a crash leaves either store on disk
+    old_dir = None
+    if os.path.isdir(out_dir):
+        old_dir = f"{os.path.normpath(out_dir)}.old.{os.getpid()}"
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir)
+
+
+def export_embeddings(out_dir, model, user_ids, creator_ids, model_name, source=None):
+    return write_store(out_dir, model_tables(model, user_ids), user_ids, creator_ids, model_name, source)
+
+
+def load_embeddings(path, mmap_mode="r"):
+    # -> (meta, {table name: array}, user_ids, creator_ids); with mmap_mode nothing is read up front
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    tables = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in meta["tables"]}
+    user_ids = np.load(os.path.join(path, "user_ids.npy"), mmap_mode=mmap_mode)
+    creator_ids = np.load(os.path.join(path, "creator_ids.npy"), mmap_mode=mmap_mode)
+    return meta, tables, user_ids, creator_ids
+
+
+def write_csv(path, ids, id_col, weight, emb_col, model_name, dt_time=None):
+    # the old stringified-list csv, kept for consumers that still load it into bigquery
+    df = pd.DataFrame({id_col: ids})
+    df['time'] = dt_time or datetime.datetime.now()
+    df['model_name'] = model_name
+    df[emb_col] = weight.tolist()
+    df.to_csv(path, index=False)
+
+
+def pretrained_csv_source(uemb_dir, cemb_dir):
+    return {"uemb": input_files(uemb_dir), "cemb": input_files(cemb_dir)}
+
+
+def pretrained_store_current(store_path, uemb_dir, cemb_dir):
+    # True if store_path was converted from the csv files now in uemb_dir / cemb_dir
+    # (same names, sizes and mtimes, as dataset.cache_key); False when any was added,
+    # removed or rewritten since, or there is no store yet
+    meta_path = os.path.join(store_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get("source") == pretrained_csv_source(uemb_dir, cemb_dir)
+
+
+def store_from_pretrained_csv(uemb_dir, cemb_dir, out_dir, dim=64):
+    # conversion of the bigquery extracts (userId, userIndex (1-based), ue0..ue63 and the
+    # creator equivalent) into an embedding store; meta.json records the csv files it read
+    source = pretrained_csv_source(uemb_dir, cemb_dir)
+    tables = {}
+    ids = {}
+    for name, directory, id_col, index_col, prefix in [("uemb", uemb_dir, "userId", "userIndex", "ue"),
+                                                       ("cemb", cemb_dir, "creatorId", "creatorIndex", "ce")]:
+        cols = [prefix + str(i) for i in range(dim)]
+        dtypes = {c: np.float32 for c in cols}
+        df = pd.concat([pd.read_csv(os.path.join(directory, i), usecols=[id_col, index_col] + cols, dtype=dtypes)
+                        for i in sorted(os.listdir(directory))])
+        df = df.sort_values(index_col)
+        tables[name] = df[cols].to_numpy(dtype=np.float32)
+        ids[name] = df[id_col].to_numpy()
+    return write_store(out_dir, tables, ids["uemb"], ids["cemb"], "pretrained_csv", source=source)
+
+
+def changed_rows(new, old, chunk_rows=1 << 20):
+    # rows of new that differ from old, plus every row past the end of old (new ids)
+    n_old = min(len(old), len(new))
+    changed = [np.arange(n_old, len(new))]
+    for start in range(0, n_old, chunk_rows):
+        end = min(start + chunk_rows, n_old)
+        diff = np.any(new[start:end] != old[start:end], axis=1)
+        changed.insert(-1, start + np.flatnonzero(diff))
+    return np.concatenate(changed).astype(np.int64)
+
+
+def export_delta(out_dir, base_path, model, user_ids, creator_ids, model_name):
+    # Only the rows that differ from the store at base_path:
+    #   <table>.rows.npy   int64 row numbers
+    #   <table>.ids.npy    the user/creator id of each of those rows
+    #   <table>.npy        float32 [len(rows), dim] new values
+    #   manifest.json      base store + its timestamp, model name, time, rows per table
+    base_meta, base_tables, _, _ = load_embeddings(base_path)
+    tmp_dir = f"{os.path.normpath(out_dir)}.tmp.{os.getpid()}"
+    os.makedirs(tmp_dir)
+    manifest = {
+        "base": os.path.abspath(base_path),
+        "base_time": base_meta["time"],
+        "model_name": model_name,
+        "time": datetime.datetime.now().isoformat(),
+        "tables": {},
+    }
+    for name, new in model_tables(model).items():
+        if name in base_tables:
+            rows = changed_rows(new, base_tables[name])
+        else:
+            # table the base store does not have (e.g. biases of a csv-converted store): relative to zeros
+            rows = np.flatnonzero(np.any(new != 0, axis=1)).astype(np.int64)
+        ids = np.asarray(user_ids if name in USER_TABLES else creator_ids)
+        np.save(os.path.join(tmp_dir, f"{name}.rows.npy"), rows)
+        np.save(os.path.join(tmp_dir, f"{name}.ids.npy"), ids[rows])
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(new[rows], dtype=np.float32))
+        manifest["tables"][name] = {
+            "changed_rows": len(rows),
+            "rows": new.shape[0],
+            "dim": new.shape[1],
+            "ids": "user" if name in USER_TABLES else "creator",
+        }
+        print(f"delta {name}: {len(rows)} of {new.shape[0]} rows changed")
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    publish_dir(tmp_dir, out_dir)
+    return manifest
+
+
+def apply_delta(store_path, delta_path):
+    # Updates the store at store_path in place when the delta only touches existing rows
+    # (the changed rows are written through a writable mmap). If the delta adds rows, the
+    # store is rewritten with the tables and id arrays grown to the new size.
+    with open(os.path.join(delta_path, "manifest.json")) as f:
+        manifest = json.load(f)
+    meta, tables, user_ids, creator_ids = load_embeddings(store_path)
+    grows = any(t["rows"] > meta["tables"].get(name, {"rows": 0})["rows"] for name, t in manifest["tables"].items())
+    if not grows:
+        for name in manifest["tables"]:
+            rows = np.load(os.path.join(delta_path, f"{name}.rows.npy"))
+            table = np.load(os.path.join(store_path, f"{name}.npy"), mmap_mode="r+")
+            table[rows] = np.load(os.path.join(delta_path, f"{name}.npy"))
+            table.flush()
+        meta["time"] = manifest["time"]
+        with open(os.path.join(store_path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+    ids = {"user": np.asarray(user_ids), "creator": np.asarray(creator_ids)}
+    new_tables = {name: np.asarray(t) for name, t in tables.items()}
+    for name, t in manifest["tables"].items():
+        rows = np.load(os.path.join(delta_path, f"{name}.rows.npy"))
+        values = np.load(os.path.join(delta_path, f"{name}.npy"))
+        table = np.zeros((t["rows"], t["dim"]), dtype=np.float32)
+        if name in new_tables:
+            table[:len(new_tables[name])] = new_tables[name]
+        table[rows] = values
+        new_tables[name] = table
+        if t["rows"] > len(ids[t["ids"]]):
+            grown = np.zeros(t["rows"], dtype=ids[t["ids"]].dtype)
+            grown[:len(ids[t["ids"]])] = ids[t["ids"]]
+            grown[rows] = np.load(os.path.join(delta_path, f"{name}.ids.npy"))
+            ids[t["ids"]] = grown
+    return write_store(store_path, new_tables, ids["user"], ids["creator"], manifest["model_name"], meta.get("source"))
@@ -0,0 +1,109 @@
+import copy
+import queue
+import threading
+
+import torch
+
+from checkpoint import atomic_save
+from metrics import binnedMetrics
+
+
+def sample_tensors(dataset, n_rows, generator=None):
+    # fixed validation subsample of a columnarDataset, gathered once up front
+    n_rows = min(n_rows, len(dataset))
+    idx = torch.randperm(len(dataset), generator=generator)[:n_rows]
+    return dataset[idx]
+
+
+def predict_tensors(model, tensors, batch_size):
+    u_ind, c_ind, labels = tensors
+    metrics = binnedMetrics()
+    with torch.no_grad():
+        for start in range(0, len(labels), batch_size):
+            end = start + batch_size
+            metrics.update(model(u_ind[start:end], c_ind[start:end]).numpy(), labels[start:end].numpy())
+    return metrics
+
+
+class asyncEvaluator:
+    # evaluates a copy of the model weights in a background thread, so the training loop
+    # only pays for the weight copy. At most one evaluation runs at a time: submit() while
+    # one is in flight is skipped rather than queued. Keeps one extra copy of the model in memory.
+    # The best snapshot is written to checkpoint_path from the same thread (atomic rename), so
+    # save() of an externally evaluated model is ordered with those writes.
+    def __init__(self, model, val_tensors, batch_size=524280, checkpoint_path=None):
+        self.snapshot = copy.deepcopy(model)
+        self.snapshot.eval()
+        self.val_tensors = val_tensors
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.min_loss = float("inf")
+        self.requests = queue.Queue(maxsize=1)
+        self.results = queue.Queue()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model, step):
+        if not self.idle.is_set():
+            return False
+        self.idle.clear()
+        with torch.no_grad():
+            self.snapshot.load_state_dict(model.state_dict())
+        self.requests.put(("eval", step))
+        return True
+
+    def save(self, model):
+        # write model to checkpoint_path in the background, e.g. after an evaluation done
+        # elsewhere improved min_loss; waits for an in-flight evaluation first
+        self.idle.wait()
+        self.idle.clear()
+        with torch.no_grad():
+            self.snapshot.load_state_dict(model.state_dict())
+        self.requests.put(("save", None))
+
+    def poll(self):
+        # (step, loss, auc) for every evaluation finished since the last call
+        out = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return out
+            if isinstance(result, BaseException):
+                raise result
+            out.append(result)
+
+    def wait(self):
+        self.idle.wait()
+        return self.poll()
+
+    def close(self):
+        results = self.wait()
+        self.requests.put(None)
+        self.thread.join()
+        return results
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            kind, step = request
+            try:
+                if kind == "save":
+                    atomic_save(self.snapshot.state_dict(), self.checkpoint_path)
+                    continue
+                metrics = predict_tensors(self.snapshot, self.val_tensors, self.batch_size)
+                loss = metrics.log_loss()
+                auc = metrics.roc_auc()
+                if loss < self.min_loss:
+                    self.min_loss = loss
+                    if self.checkpoint_path:
+                        atomic_save(self.snapshot.state_dict(), self.checkpoint_path)
+                self.results.put((step, loss, auc))
+            except BaseException as e:
+                self.results.put(e)
+            finally:
+                self.idle.set()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# checkpoint from train.py + its embedding store (for the ids) -> TorchScript scoring artifact for score.py
+import argparse
+
+from embeddings import load_embeddings
+from inference import export_torchscript, load_checkpoint
+from model import MODEL_TYPES
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-type", type=str, required=True, choices=MODEL_TYPES)
+    parser.add_argument("--checkpoint", default="model_out/model_scratch.pt", help="state_dict saved by train.py")
+    parser.add_argument("--emb-store", default="model_out/emb_model_scratch", help="embedding export of the same run, for the id -> row maps")
+    parser.add_argument("-o", "--output", default="model_out/scorer_model_scratch")
+    parser.add_argument("--atol", type=float, default=1e-5, help="max allowed |traced - eager| score difference")
+    args = parser.parse_args()
+
+    model = load_checkpoint(args.model_type, args.checkpoint)
+    _, _, user_ids, creator_ids = load_embeddings(args.emb_store)
+    meta = export_torchscript(args.output, model, args.model_type, user_ids, creator_ids, atol=args.atol)
+    print(f"exported {args.model_type} to {args.output}: {meta}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+
+def autocast_context(bf16):
+    # CPU autocast: matmuls / linear / attention run in bfloat16, the parameters (the
+    # embedding tables included) stay float32 master weights and get float32 gradients
+    if bf16:
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def make_forward_loss(model, loss_fn, bf16=False, compile=False):
+    # -> fn(u_ind, c_ind, labels) returning the float32 loss; the caller runs loss.backward()
+    # and optimizer.step(). The loss is computed outside autocast on float32 predictions
+    # (binary cross entropy is not autocast-safe). compile=True wraps the function in
+    # torch.compile (torch >= 2.0): AOTAutograd traces the backward of the returned loss as
+    # well, so loss.backward() runs the compiled backward graph; only optimizer.step() stays
+    # eager. Compiled backward graphs cannot produce sparse gradients, so compile=True needs
+    # dense embedding tables (train.py's --optimizer adam). The first calls pay for
+    # compilation, and batches of a new size (the last, smaller batch of an epoch) trigger
+    # one recompile.
+    def forward_loss(u_ind, c_ind, labels):
+        with autocast_context(bf16):
+            preds = model(u_ind, c_ind)
+        return loss_fn(preds.float(), labels)
+
+    if compile:
+        assert hasattr(torch, "compile"), "--compile needs torch >= 2.0"
+        if any(isinstance(m, nn.Embedding) and m.sparse for m in model.modules()):
+            raise ValueError("torch.compile compiles the backward too, which does not support sparse "
+                             "embedding gradients: build the model with sparse=False (--optimizer adam)")
+        return torch.compile(forward_loss)
+    return forward_loss
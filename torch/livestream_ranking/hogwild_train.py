@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Hogwild (lock-free asynchronous SGD) training for the dot-product rankers.
+# The embedding and bias tables live in shared memory; every worker process trains on a
+# disjoint shard of the train rows and writes its sparse row updates straight into the
+# shared tables without any locking. Prints aggregate samples/sec and the final validation
+# metrics, to compare against the synchronous loop in train.py.
+import argparse
+import time
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+
+from dataset import create_dataset, id_maps
+from evaluation import predict_tensors
+from instrumentation import stepInstrumentation, print_summary
+from model import columnarDataset, batchIndexSampler, create_model
+from sparse_optim import rowWiseAdagrad
+
+
+def worker(rank, args, model, train_tensors, results):
+    torch.set_num_threads(args.threads_per_worker)
+    torch.manual_seed(args.seed + rank)
+    # optimizer state is private to the worker; only the weights are shared.
+    # rowwise-adagrad keeps one float per row, so a copy per worker stays small
+    if args.optimizer == "sgd":
+        optimizer = optim.SGD(model.parameters(), lr=args.lr)
+    else:
+        optimizer = rowWiseAdagrad(model.parameters(), lr=args.lr)
+    loss_fn = nn.BCELoss()
+    u_all, c_all, labels_all = (t[rank::args.workers] for t in train_tensors)
+    sampler = batchIndexSampler(len(labels_all), args.batch_size, shuffle=True)
+    instr = stepInstrumentation(f"{args.instrument}.worker{rank}" if args.instrument else None)
+    rows = 0
+    # wall-clock (not perf_counter) so the parent can line up the workers' training windows
+    start = time.time()
+    for epoch in range(args.epochs):
+        total_loss = 0
+        step = 0
+        for idx in sampler:
+            instr.begin_step(epoch, step)
+            u_ind, c_ind, labels = u_all[idx], c_all[idx], labels_all[idx]
+            instr.mark("gather")
+            model.zero_grad()
+            loss = loss_fn(model(u_ind, c_ind), labels)
+            instr.mark("forward")
+            loss.backward()
+            instr.mark("backward")
+            optimizer.step()
+            instr.mark("optimizer")
+            total_loss += loss.item()
+            rows += len(idx)
+            step += 1
+            instr.end_step(len(idx))
+        print(f"worker {rank} epoch {epoch} train loss: {total_loss / max(step, 1)}")
+    summary = instr.close()
+    if summary is not None:
+        print_summary(summary, f"worker {rank} step timings:")
+    results.put((rank, rows, start, time.time()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-type", type=str, required=True, choices=["rankerOld", "rankerV0"])
+    parser.add_argument("-i", "--input", default="livestream_ranker_train_data", help="path to local directory with .csv files")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--threads-per-worker", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=4096, help="per worker; smaller batches mean more, sparser lock-free updates")
+    parser.add_argument("--optimizer", default="rowwise-adagrad", choices=["sgd", "rowwise-adagrad"])
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--instrument", help="per-step phase timings as jsonl, one <path>.worker<r> file per worker")
+    args = parser.parse_args()
+
+    main_df = create_dataset(args.input)
+    user_ids, creator_ids = id_maps(main_df)
+    train_dataset = columnarDataset(main_df[main_df["val"] == "0"])
+    val_dataset = columnarDataset(main_df[main_df["val"] == "1"])
+    del main_df
+
+    torch.manual_seed(args.seed)
+    model = create_model(args.model_type, len(user_ids), len(creator_ids), args.embedding_dim, sparse=True)
+    model.share_memory()
+    train_tensors = (train_dataset.user_index, train_dataset.creator_index, train_dataset.label)
+    for t in train_tensors:
+        t.share_memory_()
+
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    start = time.perf_counter()
+    processes = []
+    for rank in range(args.workers):
+        p = ctx.Process(target=worker, args=(rank, args, model, train_tensors, results))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+    wall = time.perf_counter() - start
+    failed = [(rank, p.exitcode) for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"hogwild workers failed (rank, exit code): {failed}")
+
+    # aggregate throughput over the span in which the workers trained, from the first worker's
+    # start to the last one's end: process spawn, imports and unpickling the shared tensors excluded
+    total_rows = 0
+    starts, ends = [], []
+    while not results.empty():
+        rank, rows, worker_start, worker_end = results.get()
+        print(f"worker {rank}: {rows / (worker_end - worker_start):.0f} samples/sec")
+        total_rows += rows
+        starts.append(worker_start)
+        ends.append(worker_end)
+    train_wall = max(ends) - min(starts)
+    print(f"hogwild {args.model_type} workers={args.workers}: {total_rows / train_wall:.0f} samples/sec aggregate, "
+          f"{train_wall:.1f}s training, {wall:.1f}s wall including process startup")
+
+    torch.set_num_threads(args.workers * args.threads_per_worker)
+    model.eval()
+    val_tensors = (val_dataset.user_index, val_dataset.creator_index, val_dataset.label)
+    val_metrics = predict_tensors(model, val_tensors, batch_size=524280)
+    print("val metrics: ", val_metrics.result())
+
+
+if __name__ == "__main__":
+    main()
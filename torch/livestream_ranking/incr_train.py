@@ -1,37 +1,54 @@
 import torch.nn as nn
 import torch.optim as optim
 
-from torch.utils.data import DataLoader
 import torch
-from model import catDataset, rankerV0
+from model import columnarDataset, columnar_dataloader, rankerV0, grow_embedding
+from registry import idRegistry
+from metrics import binnedMetrics
+from checkpoint import checkpointWriter, clone_state
+from embeddings import (export_embeddings, export_delta, load_embeddings, pretrained_store_current,
+                        store_from_pretrained_csv, write_csv)
 
 import pandas as pd
 import numpy as np
 import os
 
-import datetime
-from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
 
-## reading pretrained user embeddings
+## pretrained user/creator tables, as a binary embedding store (see embeddings.write_store).
+## the bigquery csv extracts are converted into one on first use, and again whenever they change
 uemb_dir = "livestream_ranker_pretrained_uemb/"
-uemb_df = []
-for i in os.listdir(uemb_dir):
-    uemb_df.append(pd.read_csv(uemb_dir+i))
-uemb_df = pd.concat(uemb_df).reset_index(drop=True)
-uemb_df['userIndex'] = uemb_df['userIndex'] -1
-
-## reading pretrained creator embeddings
 cemb_dir = "livestream_ranker_pretrained_cemb/"
-cemb_df = []
-for i in os.listdir(cemb_dir):
-    cemb_df.append(pd.read_csv(cemb_dir+i))
-cemb_df = pd.concat(cemb_df).reset_index(drop=True)
-cemb_df['creatorIndex'] = cemb_df['creatorIndex'] - 1
+pretrained_store = "livestream_ranker_pretrained_emb"
+if not pretrained_store_current(pretrained_store, uemb_dir, cemb_dir):
+    print(f"converting the csv extracts in {uemb_dir} and {cemb_dir} into {pretrained_store}")
+    store_from_pretrained_csv(uemb_dir, cemb_dir, pretrained_store)
+pretrained_meta = load_embeddings(pretrained_store)[0]
 
 ## reading training data
 data_directory = "livestream_ranker_train_data/"
 model_update = "model_out/"
+model_name = "model_incr"
+loss_list_name = "loss_list_incr"
+
+## every run starts from the previous run's export (its tables, including the rows of the ids
+## it appended) and its saved id registry, so an id keeps the row it got on the day it first
+## appeared. The chain starts over from the pretrained store when that is rebuilt from new
+## csv extracts (the export records the pretrained store's source)
+incr_store = f"{model_update}emb_{model_name}"
+user_registry_path = f"{model_update}{model_name}_user_registry.npy"
+creator_registry_path = f"{model_update}{model_name}_creator_registry.npy"
+chained = os.path.isdir(incr_store) and load_embeddings(incr_store)[0].get("source") == pretrained_meta["source"]
+base_store = incr_store if chained else pretrained_store
+base_meta, base_tables, user_ids, creator_ids = load_embeddings(base_store)
+print(f"starting from {base_store} ({base_meta['model_name']}, {base_meta['time']})")
+# also write the old stringified-list csv embeddings next to the binary export
+export_csv = False
+# train only on the newest interaction_date before the validation day (the newest day of the
+# data, val == 1); the older days are already in the base tables
+newest_day_only = True
+# give ids that are not in the base tables new rows (appended, see registry.idRegistry) instead of dropping them
+grow_tables = True
 os.listdir(data_directory)
 
 df_list = []
@@ -43,64 +60,89 @@ for i in os.listdir(data_directory):
 main_df = pd.concat(df_list).reset_index(drop=True)
 main_df.rename(columns={'hostId': 'creatorId', 'memberId': 'userId'}, inplace=True)
 
-## assiging indexes to ids (for training purpose)
-main_df = main_df.merge(uemb_df[['userId','userIndex']],how='inner',on='userId')
-main_df = main_df.merge(cemb_df[['creatorId','creatorIndex']],how='inner',on='creatorId')
+if newest_day_only and 'interaction_date' in main_df.columns:
+    newest_day = main_df.loc[main_df['val'] == 0, 'interaction_date'].max()
+    main_df = main_df[(main_df['interaction_date'] == newest_day) | (main_df['val'] == 1)].reset_index(drop=True)
+    print(f"training on {newest_day} only: {int((main_df['val'] == 0).sum())} rows, "
+          f"validating on {int((main_df['val'] == 1).sum())} rows")
+
+## assiging indexes to ids (for training purpose): rows in the base tables are stable,
+## new ids are appended after them. The registries are saved as soon as the new ids have rows,
+## so a run that fails later does not give those ids different rows the next day
+if chained and os.path.exists(user_registry_path) and os.path.exists(creator_registry_path):
+    user_registry = idRegistry.load(user_registry_path)
+    creator_registry = idRegistry.load(creator_registry_path)
+else:
+    user_registry = idRegistry(user_ids)
+    creator_registry = idRegistry(creator_ids)
+for registry, ids, path in [(user_registry, user_ids, user_registry_path), (creator_registry, creator_ids, creator_registry_path)]:
+    if len(registry) < len(ids) or not np.array_equal(registry.ids[:len(ids)], ids):
+        raise SystemExit(f"{path} does not start with the ids of {base_store}")
+if grow_tables:
+    main_df['userIndex'] = user_registry.add(main_df['userId'].to_numpy())
+    main_df['creatorIndex'] = creator_registry.add(main_df['creatorId'].to_numpy())
+    print(f"new users: {len(user_registry) - len(user_ids)}, new creators: {len(creator_registry) - len(creator_ids)}")
+else:
+    main_df['userIndex'] = user_registry.lookup(main_df['userId'].to_numpy())
+    main_df['creatorIndex'] = creator_registry.lookup(main_df['creatorId'].to_numpy())
+    unknown = (main_df['userIndex'] < 0) | (main_df['creatorIndex'] < 0)
+    print(f"dropping {unknown.sum()} of {len(main_df)} rows: "
+          f"{main_df.loc[main_df['userIndex'] < 0, 'userId'].nunique()} users and "
+          f"{main_df.loc[main_df['creatorIndex'] < 0, 'creatorId'].nunique()} creators are not in the base tables")
+    main_df = main_df[~unknown]
+os.makedirs(model_update, exist_ok=True)
+user_registry.save(user_registry_path)
+creator_registry.save(creator_registry_path)
 print(f"n_user: {len(main_df['userIndex'].unique())}, n_creator: {len(main_df['creatorIndex'].unique())}")
 
 def predict(model, dataloader, feature_x=False, is_sample=False):
-    pred_lis = []
-    label_lis = []
-    loss_lis = []
+    metrics = binnedMetrics()
     step = 0
     for batch in dataloader:
         if feature_x:
             u_ind, c_ind, features, labels = batch[0].to(device), batch[1].to(device), batch[2].to(device), batch[3].to(
                 device)
             preds = model(u_ind, c_ind, features)
-            loss = CELoss(preds, labels)
             #             print(preds.shape, labels.shape)
             preds = torch.nn.functional.softmax(preds, dim=1)[:, 1]
         else:
             u_ind, c_ind, labels = batch[0].to(device), batch[1].to(device), batch[2].to(device)
             preds = model(u_ind, c_ind)
-            loss = CELoss(preds, labels)
-
-        # print(loss.item())
-        preds = preds.detach().cpu().numpy()
 
-        labels = labels.detach().cpu().numpy()
-        # pred_cls = np.argmax(preds, axis=1)
-        pred_lis.extend(preds)
-        label_lis.extend(labels)
-        loss_lis.append(loss.cpu().item())
+        metrics.update(preds.detach().cpu().numpy(), labels.detach().cpu().numpy())
         step += 1
         if is_sample and step == 10:
             break
 
-    return np.array(pred_lis), np.array(label_lis), np.mean(loss_lis)
+    return metrics
 
 torch.set_num_threads(8)
 main_df['label'] = main_df['total_timespent'].apply(lambda x: 1 if x*60>=60 else 0)
 
 # train_data, val_data = train_test_split(main_df, test_size=.2, stratify=main_df['label'])
-train_dataset = catDataset(main_df[main_df['val']==0])
-train_dataloader = DataLoader(train_dataset, batch_size= 8192, shuffle=True)
-val_dataset = catDataset(main_df[main_df['val']==1])
-val_dataloader = DataLoader(val_dataset, batch_size= 8192, shuffle=True)
-
-
-uemb_df = uemb_df.sort_values('userIndex').reset_index(drop=True)
-cemb_df = cemb_df.sort_values('creatorIndex').reset_index(drop=True)
-u_cols = ["ue"+str(i) for i in range(64)]
-c_cols = ["ce"+str(i) for i in range(64)]
-model = rankerV0(torch.tensor(uemb_df[u_cols].to_numpy()),torch.tensor(cemb_df[c_cols].to_numpy()), ispretrained=True).float()
+train_dataset = columnarDataset(main_df[main_df['val']==0])
+train_dataloader = columnar_dataloader(train_dataset, batch_size= 8192, shuffle=True)
+val_dataset = columnarDataset(main_df[main_df['val']==1])
+val_dataloader = columnar_dataloader(val_dataset, batch_size= 8192, shuffle=True)
+if len(train_dataset) == 0:
+    raise SystemExit(f"no training rows (val == 0) in {data_directory}")
+if len(val_dataset) == 0:
+    raise SystemExit(f"no validation rows (val == 1) in {data_directory}")
+
+
+model = rankerV0(torch.from_numpy(np.array(base_tables['uemb'])), torch.from_numpy(np.array(base_tables['cemb'])), ispretrained=True).float()
+with torch.no_grad():
+    for name in ['user_bias', 'creator_bias']:
+        if name in base_tables:
+            getattr(model, name).weight.copy_(torch.from_numpy(np.array(base_tables[name])))
 
 device = torch.device("cpu")
 learning_rate =.01
 CELoss = nn.BCELoss()
 model.to(device)
 optimizer = optim.Adam(model.parameters(),lr = learning_rate)
+for name, registry in [('uemb', user_registry), ('user_bias', user_registry), ('cemb', creator_registry), ('creator_bias', creator_registry)]:
+    grow_embedding(model, name, len(registry), optimizer)
 print("model will run on: {}".format(device))
 
 
@@ -113,8 +155,10 @@ val_roc=[]
 min_loss = 9999999
 
 
-model_name = "model_incr"
-loss_list_name = "loss_list_incr"
+# best-model saves are snapshotted here and written (atomic rename) by a background thread
+writer = checkpointWriter(model_update)
+# one "epoch step loss" line per train step
+loss_log = open(f"{loss_list_name}.txt", "w")
 for epoch in range(2):
     print(epoch)
     total_loss = 0
@@ -140,53 +184,50 @@ for epoch in range(2):
         loss_item = loss.item()
         loss_lis_train.append(loss_item)
         total_loss += loss_item
+        loss_log.write(f"{epoch} {step} {loss_item:.6f}\n")
 
         # progress update after every 100 batches.
         if step % 50 == 0 and not step == 0:
             print("loss: ", total_loss / step)
             torch.cuda.empty_cache()
-            prediction, true, _ = predict(model, val_dataloader, is_sample=True)
+            val_metrics = predict(model, val_dataloader, is_sample=True)
+            _ = val_metrics.log_loss()
             val_loss.append(_)
-            met = roc_auc_score(true, prediction)
+            met = val_metrics.roc_auc()
             print("roc_auc: ", met)
             val_roc.append(met)
             if _ < min_loss:
                 min_loss = _
-                torch.save(model.state_dict(), f"{model_update}{model_name}.pt")
+                writer.save(clone_state(model.state_dict()), f"{model_update}{model_name}.pt")
             # if epoch >= 3 and is_early :
             #     if val_loss[-1] > val_loss[-2] and val_loss[-2] > val_loss[-3] and val_loss[-3] > val_loss[-4]:
             #         print("stopping training")
             #         break
 
         step += 1
-    f = open(f"{loss_list_name}.txt", "w")
-    f.write(str(loss_lis_train))
-    f.close()
+    loss_log.flush()
     train_loss.append(total_loss / step)
     print("loss: ", total_loss / step)
     model.eval()
-    prediction, true, _ = predict(model, val_dataloader)
+    val_metrics = predict(model, val_dataloader)
+    _ = val_metrics.log_loss()
 
     if _ < min_loss:
         min_loss = _
-        torch.save(model.state_dict(), model_name)
-
-    met = roc_auc_score(true, prediction)
-    print("roc_auc: ", met)
-
-dt_time = datetime.datetime.now()
-u_dict = main_df[['userIndex','userId']].drop_duplicates('userId').set_index('userIndex', drop=True)
-u_dict.sort_index(inplace=True)
-u_dict['time'] = dt_time
-u_dict['model_name'] = "rankerV0"
-u_dict['uemb'] = model.uemb.weight.data.numpy().tolist()
-u_dict.to_csv(f"{model_update}user_emb_{model_name}.csv", index=False)
-
-c_dict = main_df[['creatorIndex','creatorId']].drop_duplicates('creatorId').set_index('creatorIndex', drop=True)
-c_dict.sort_index(inplace=True)
-c_dict['time'] = dt_time
-c_dict['model_name'] = "rankerV0"
-c_dict['cemb'] = model.cemb.weight.data.numpy().tolist()
-c_dict.to_csv(f"{model_update}creator_emb_{model_name}.csv", index=False)
+        writer.save(clone_state(model.state_dict()), f"{model_update}{model_name}.pt")
+
+    print("val metrics: ", val_metrics.result())
+
+writer.close()
+loss_log.close()
+
+# rows of the tables are the registry rows: the base ids followed by the new ones.
+# the delta holds only the rows that training changed, for consumers that keep a copy of the
+# base store (embeddings.apply_delta); it is written first, as the export replaces the base store
+export_delta(f"{model_update}emb_{model_name}_delta", base_store, model, user_registry.ids, creator_registry.ids, "rankerV0")
+export_embeddings(incr_store, model, user_registry.ids, creator_registry.ids, "rankerV0", source=pretrained_meta["source"])
+if export_csv:
+    write_csv(f"{model_update}user_emb_{model_name}.csv", user_registry.ids, 'userId', model.uemb.weight.data.numpy(), 'uemb', "rankerV0")
+    write_csv(f"{model_update}creator_emb_{model_name}.csv", creator_registry.ids, 'creatorId', model.cemb.weight.data.numpy(), 'cemb', "rankerV0")
 
 #torch.save(model.state_dict(), f"{model_update}{model_name}_last_step.pt")
@@ -0,0 +1,105 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from embeddings import USER_TABLES, CREATOR_TABLES
+from model import create_model, require_row_user_tables
+from registry import idIndex
+
+
+def table_sizes(state_dict):
+    # (user rows, creator rows, embedding dim) of a ranker checkpoint
+    hashed = sorted({k.split(".")[0] for k in state_dict if ".tables." in k})
+    if hashed:
+        raise ValueError(f"checkpoint was trained with --user-hash (hashed tables: {', '.join(hashed)}); "
+                         "export and scoring map userIds to rows and do not support it")
+    n_uemb = n_cemb = None
+    dim = 64
+    for name in USER_TABLES + CREATOR_TABLES:
+        weight = state_dict.get(f"{name}.weight")
+        if weight is None:
+            continue
+        if name in USER_TABLES:
+            n_uemb = weight.shape[0]
+        else:
+            n_cemb = weight.shape[0]
+        if weight.shape[1] > 1:
+            dim = weight.shape[1]
+    return n_uemb, n_cemb, dim
+
+
+def load_checkpoint(model_type, checkpoint_path):
+    state_dict = torch.load(checkpoint_path, map_location="cpu")
+    n_uemb, n_cemb, dim = table_sizes(state_dict)
+    model = create_model(model_type, n_uemb, n_cemb, dim)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def export_torchscript(out_dir, model, model_type, user_ids, creator_ids, check_rows=65536, atol=1e-5):
+    # Layout of out_dir:
+    #   model.pt          traced TorchScript module, (userIndex, creatorIndex) -> score
+    #   user_ids.npy      row ids of the user tables (see embeddings.write_store)
+    #   creator_ids.npy   same for the creators
+    #   user_index.*.npy, creator_index.*.npy   registry.idIndex over those ids
+    #   meta.json         model type, table sizes and the max |traced - eager| seen on check_rows random pairs
+    require_row_user_tables(model, "export_torchscript")
+    n_uemb, n_cemb, _ = table_sizes(model.state_dict())
+    model.eval()
+    u_ind = torch.randint(0, n_uemb, (check_rows,))
+    c_ind = torch.randint(0, n_cemb, (check_rows,))
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (u_ind, c_ind))
+        max_abs_diff = (traced(u_ind, c_ind) - model(u_ind, c_ind)).abs().max().item()
+    if max_abs_diff > atol:
+        raise ValueError(f"traced model differs from eager by {max_abs_diff} > {atol}")
+    os.makedirs(out_dir, exist_ok=True)
+    traced.save(os.path.join(out_dir, "model.pt"))
+    np.save(os.path.join(out_dir, "user_ids.npy"), np.asarray(user_ids))
+    np.save(os.path.join(out_dir, "creator_ids.npy"), np.asarray(creator_ids))
+    idIndex.from_ids(user_ids).save(out_dir, "user")
+    idIndex.from_ids(creator_ids).save(out_dir, "creator")
+    meta = {
+        "model_type": model_type,
+        "n_users": n_uemb,
+        "n_creators": n_cemb,
+        "max_abs_diff": max_abs_diff,
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_scorer(model_dir):
+    # -> (TorchScript module, user idIndex, creator idIndex, meta); the indexes are memory-mapped,
+    # artifacts exported before they existed get them built from the id arrays
+    module = torch.jit.load(os.path.join(model_dir, "model.pt"), map_location="cpu")
+    module.eval()
+    user_registry, creator_registry = (load_index(model_dir, name) for name in ("user", "creator"))
+    with open(os.path.join(model_dir, "meta.json")) as f:
+        meta = json.load(f)
+    return module, user_registry, creator_registry, meta
+
+
+def load_index(model_dir, name):
+    if idIndex.exists(model_dir, name):
+        return idIndex.load(model_dir, name)
+    return idIndex.from_ids(np.load(os.path.join(model_dir, f"{name}_ids.npy")))
+
+
+def score_indices(module, u_ind, c_ind, batch_size=524288):
+    # scores for index pairs, NaN where either index is -1 (id unknown to the model)
+    u_ind = np.asarray(u_ind)
+    c_ind = np.asarray(c_ind)
+    scores = np.full(len(u_ind), np.nan, dtype=np.float32)
+    known = np.flatnonzero((u_ind >= 0) & (c_ind >= 0))
+    with torch.no_grad():
+        for start in range(0, len(known), batch_size):
+            rows = known[start:start + batch_size]
+            u = torch.from_numpy(u_ind[rows].astype(np.int64))
+            c = torch.from_numpy(c_ind[rows].astype(np.int64))
+            scores[rows] = module(u, c).numpy()
+    return scores
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Per-phase step timing for the training loops, written as one JSON object per step.
+# `python instrumentation.py steps.jsonl [...]` prints the percentile summary of finished runs.
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+
+def rss_mb():
+    # current resident set size; ru_maxrss (the peak) where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class stepInstrumentation:
+    # Usage in a training loop:
+    #   for batch in dataloader:
+    #       instr.begin_step(epoch, step)     # time since the previous end_step -> "data"
+    #       ... forward ...;   instr.mark("forward")
+    #       ... backward ...;  instr.mark("backward")
+    #       ... step ...;      instr.mark("optimizer")
+    #       instr.end_step(n_samples)
+    # mark(phase) charges the time since the previous mark to phase. Besides the phases every
+    # record has step_ms, samples_per_sec, rss_mb and cpu_util (process cpu time / wall time /
+    # torch threads from begin_step to end_step, i.e. how busy the intra-op threads were).
+    # The overhead is a few perf_counter / getrusage calls per step; with path=None every
+    # method returns at once. Call pause() before work between steps that is not a batch fetch
+    # (epoch-end validation), the next step then reports data_ms = 0.
+    #
+    # profile_steps=(start, end) wraps steps [start, end) counted from the first begin_step
+    # in torch.profiler and writes a chrome trace to trace_path when the window closes.
+    def __init__(self, path=None, profile_steps=None, trace_path=None):
+        self.enabled = path is not None
+        self.path = path
+        self.profile_steps = profile_steps
+        self.trace_path = trace_path
+        self.profiler = None
+        self.n_steps = 0
+        self.last_end = None
+        if self.enabled:
+            self.file = open(path, "w")
+
+    def pause(self):
+        self.last_end = None
+
+    def begin_step(self, epoch, step):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.profile_steps is not None and self.n_steps == self.profile_steps[0]:
+            self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+            self.profiler.__enter__()
+        self.record = {"epoch": epoch, "step": step}
+        # first step after pause(): nothing to measure the batch fetch against
+        self.record["data_ms"] = (now - self.last_end) * 1000 if self.last_end is not None else 0.0
+        self.step_start = self.last_end if self.last_end is not None else now
+        self.body_start = now
+        self.last_mark = now
+        self.cpu_start = cpu_seconds()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.record[f"{phase}_ms"] = self.record.get(f"{phase}_ms", 0.0) + (now - self.last_mark) * 1000
+        self.last_mark = now
+
+    def end_step(self, n_samples):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        step_seconds = now - self.step_start
+        self.record["step_ms"] = step_seconds * 1000
+        self.record["samples_per_sec"] = n_samples / step_seconds if step_seconds > 0 else 0.0
+        self.record["rss_mb"] = rss_mb()
+        self.record["cpu_util"] = (cpu_seconds() - self.cpu_start) / max(now - self.body_start, 1e-9) / torch.get_num_threads()
+        self.file.write(json.dumps(self.record) + "\n")
+        self.n_steps += 1
+        if self.profiler is not None and self.n_steps == self.profile_steps[1]:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_path)
+            print(f"profiler trace of steps {self.profile_steps[0]}..{self.profile_steps[1] - 1} written to {self.trace_path}")
+            self.profiler = None
+        # the profiler export above is not part of the next step's data phase
+        self.last_end = time.perf_counter()
+
+    def close(self):
+        if not self.enabled:
+            return None
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_path)
+            self.profiler = None
+        self.file.close()
+        return summarize(self.path)
+
+
+def load_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(path, percentiles=(50, 90, 99)):
+    # {field: {"mean": ..., "p50": ..., ...}} over all steps of a jsonl file
+    records = load_records(path)
+    fields = []
+    for r in records:
+        fields += [k for k in r if k not in ("epoch", "step") and k not in fields]
+    summary = {}
+    for field in fields:
+        values = np.array([r.get(field, 0.0) for r in records], dtype=np.float64)
+        summary[field] = {"mean": float(values.mean())}
+        for p in percentiles:
+            summary[field][f"p{p}"] = float(np.percentile(values, p))
+    return summary
+
+
+def print_summary(summary, title=""):
+    if title:
+        print(title)
+    if not summary:
+        print("  no steps recorded")
+        return
+    columns = list(next(iter(summary.values())).keys())
+    print(f"  {'':16s}" + "".join(f"{c:>12s}" for c in columns))
+    for field, stats in summary.items():
+        print(f"  {field:16s}" + "".join(f"{stats[c]:12.2f}" for c in columns))
+
+
+if __name__ == "__main__":
+    for p in sys.argv[1:]:
+        print_summary(summarize(p), p)
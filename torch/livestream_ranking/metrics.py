@@ -0,0 +1,120 @@
+import numpy as np
+
+LOG_EPS = 1e-7
+
+
+class binnedMetrics:
+    # Streaming AUC / PR-AUC / log loss / calibration for binary labels and predictions in [0, 1].
+    #
+    # Predictions are bucketed into n_bins equal-width bins and only per-bin positive/negative
+    # counts are kept, so memory is O(n_bins) regardless of how many rows are seen, and two
+    # accumulators with the same n_bins merge exactly (counts are integers, sums are float64).
+    #
+    # Accuracy vs sklearn: the only approximation is that pairs whose predictions fall into the
+    # same bin are scored as ties. roc_auc() therefore differs from sklearn.metrics.roc_auc_score
+    # by at most auc_error_bound() = 0.5 * sum_b(pos_b * neg_b) / (P * N), which this class
+    # reports. bench_metrics.py prints the measured difference to sklearn for both AUCs and the
+    # log loss at a given bin count.
+    def __init__(self, n_bins=10000):
+        self.n_bins = n_bins
+        self.pos = np.zeros(n_bins, dtype=np.int64)
+        self.neg = np.zeros(n_bins, dtype=np.int64)
+        self.log_loss_sum = 0.0
+        self.pred_sum = 0.0
+
+    def update(self, preds, labels):
+        preds = np.asarray(preds, dtype=np.float64).ravel()
+        labels = np.asarray(labels).ravel() > 0.5
+        bins = np.clip((preds * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        self.pos += np.bincount(bins[labels], minlength=self.n_bins)
+        self.neg += np.bincount(bins[~labels], minlength=self.n_bins)
+        p = np.clip(preds, LOG_EPS, 1 - LOG_EPS)
+        self.log_loss_sum -= np.log(p[labels]).sum() + np.log1p(-p[~labels]).sum()
+        self.pred_sum += preds.sum()
+        return self
+
+    def merge(self, other):
+        assert self.n_bins == other.n_bins
+        self.pos += other.pos
+        self.neg += other.neg
+        self.log_loss_sum += other.log_loss_sum
+        self.pred_sum += other.pred_sum
+        return self
+
+    def state(self):
+        # flat float64 vector, e.g. for torch.distributed.all_reduce; counts stay exact below 2**53
+        return np.concatenate([self.pos, self.neg, [self.log_loss_sum, self.pred_sum]]).astype(np.float64)
+
+    @classmethod
+    def from_state(cls, state):
+        n_bins = (len(state) - 2) // 2
+        m = cls(n_bins)
+        m.pos = np.rint(state[:n_bins]).astype(np.int64)
+        m.neg = np.rint(state[n_bins:2 * n_bins]).astype(np.int64)
+        m.log_loss_sum = float(state[-2])
+        m.pred_sum = float(state[-1])
+        return m
+
+    @property
+    def count(self):
+        return int(self.pos.sum() + self.neg.sum())
+
+    def roc_auc(self):
+        n_pos = self.pos.sum()
+        n_neg = self.neg.sum()
+        if n_pos == 0 or n_neg == 0:
+            return float("nan")
+        neg_below = np.cumsum(self.neg) - self.neg
+        wins = (self.pos.astype(np.float64) * neg_below).sum() + 0.5 * (self.pos.astype(np.float64) * self.neg).sum()
+        return float(wins / (float(n_pos) * float(n_neg)))
+
+    def auc_error_bound(self):
+        n_pos = self.pos.sum()
+        n_neg = self.neg.sum()
+        if n_pos == 0 or n_neg == 0:
+            return float("nan")
+        return float(0.5 * (self.pos.astype(np.float64) * self.neg).sum() / (float(n_pos) * float(n_neg)))
+
+    def pr_auc(self):
+        # average precision over the bin edges, thresholds from high to low
+        n_pos = self.pos.sum()
+        if n_pos == 0:
+            return float("nan")
+        tp = np.cumsum(self.pos[::-1]).astype(np.float64)
+        fp = np.cumsum(self.neg[::-1]).astype(np.float64)
+        seen = (tp + fp) > 0
+        precision = np.divide(tp, tp + fp, out=np.zeros_like(tp), where=seen)
+        recall = tp / n_pos
+        return float((np.diff(recall, prepend=0.0) * precision).sum())
+
+    def log_loss(self):
+        if self.count == 0:
+            return float("nan")
+        return float(self.log_loss_sum / self.count)
+
+    def prediction_mean(self):
+        if self.count == 0:
+            return float("nan")
+        return float(self.pred_sum / self.count)
+
+    def label_mean(self):
+        if self.count == 0:
+            return float("nan")
+        return float(self.pos.sum()) / self.count
+
+    def calibration(self):
+        # prediction mean / label mean, 1.0 is perfectly calibrated on average
+        if self.pos.sum() == 0:
+            return float("nan")
+        return self.prediction_mean() / self.label_mean()
+
+    def result(self):
+        return {
+            "auc": self.roc_auc(),
+            "pr-auc": self.pr_auc(),
+            "log-loss": self.log_loss(),
+            "prediction_mean": self.prediction_mean(),
+            "label_mean": self.label_mean(),
+            "calibration": self.calibration(),
+            "count": self.count,
+        }
@@ -1,8 +1,12 @@
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 import torch
+import numpy as np
+import os
+
+from disk_embedding import diskEmbedding
 
 
 class catDataset(Dataset):
@@ -23,15 +27,185 @@ class catDataset(Dataset):
                 torch.tensor(self.df['label'][idx]).float())
 
 
+class columnarDataset(Dataset):
+    # same rows as catDataset, but every column is kept as one contiguous tensor and
+    # __getitem__ takes a whole batch of row ids, so a batch is a single gather per column.
+    # use through columnar_dataloader (or batch_size=None + batchIndexSampler)
+    def __init__(self, df, feature_x=False, feature_x_lis=None):
+        self.feature_x = feature_x
+        self.flis = feature_x_lis
+        self.user_index = torch.from_numpy(np.ascontiguousarray(df['userIndex'].to_numpy(dtype=np.int64)))
+        self.creator_index = torch.from_numpy(np.ascontiguousarray(df['creatorIndex'].to_numpy(dtype=np.int64)))
+        self.label = torch.from_numpy(np.ascontiguousarray(df['label'].to_numpy(dtype=np.float32)))
+        if self.feature_x:
+            self.features = torch.from_numpy(np.ascontiguousarray(df[self.flis].to_numpy(dtype=np.float32)))
+
+    def __len__(self):
+        return len(self.label)
+
+    def __getitem__(self, idx):
+        if self.feature_x:
+            return self.user_index[idx], self.creator_index[idx], self.features[idx], self.label[idx]
+        return self.user_index[idx], self.creator_index[idx], self.label[idx]
+
+
+class batchIndexSampler(Sampler):
+    # yields one LongTensor of row ids per batch (a slice of a single randperm),
+    # instead of a python list of batch_size ints like torch's BatchSampler
+    def __init__(self, n_rows, batch_size, shuffle=True, drop_last=False, generator=None):
+        self.n_rows = n_rows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_rows // self.batch_size
+        return (self.n_rows + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.n_rows, generator=self.generator)
+        else:
+            order = torch.arange(self.n_rows)
+        for i in range(len(self)):
+            yield order[i * self.batch_size:(i + 1) * self.batch_size]
+
+
+class localityBatchSampler(batchIndexSampler):
+    # batchIndexSampler whose batches touch nearby embedding rows: the epoch's randperm is cut
+    # into windows of window_batches batches, each window is sorted by keys (locality_keys:
+    # user row, then creator row) and split into batches, and the batches of a window are
+    # yielded in random order. Every row is still seen once per epoch, but a batch covers one
+    # user index range of its window instead of the whole table, so the embedding gathers and
+    # gradient scatters hit fewer, adjacent cache lines. window_batches=1 gives the same batches
+    # as batchIndexSampler, only sorted; larger windows trade batch randomness for locality.
+    def __init__(self, n_rows, batch_size, keys, window_batches=8, shuffle=True, drop_last=False, generator=None):
+        super(localityBatchSampler, self).__init__(n_rows, batch_size, shuffle, drop_last, generator)
+        self.keys = keys
+        self.window_batches = window_batches
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.n_rows, generator=self.generator)
+        else:
+            order = torch.arange(self.n_rows)
+        order = order[:len(self) * self.batch_size]
+        window_rows = self.window_batches * self.batch_size
+        for start in range(0, len(order), window_rows):
+            window = order[start:start + window_rows]
+            window = window[torch.sort(self.keys[window], stable=True).indices]
+            batches = window.split(self.batch_size)
+            if self.shuffle:
+                batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator)]
+            yield from batches
+
+
+def locality_keys(dataset):
+    # one int64 sort key per row of a columnarDataset: user row, then creator row
+    n_creators = int(dataset.creator_index.max()) + 1 if len(dataset) else 1
+    if len(dataset) and int(dataset.user_index.max()) >= (2**63 - 1) // n_creators:
+        # raw userIds as userIndex (hashed user tables): the combined key would overflow
+        return dataset.user_index
+    return dataset.user_index * n_creators + dataset.creator_index
+
+
+def columnar_dataloader(dataset, batch_size, shuffle=False, drop_last=False, locality_window=0):
+    # batch_size=None disables per-sample collation: each sampler item is already a batch.
+    # locality_window > 0: localityBatchSampler with windows of that many batches
+    if locality_window > 0:
+        sampler = localityBatchSampler(len(dataset), batch_size, locality_keys(dataset), locality_window,
+                                       shuffle=shuffle, drop_last=drop_last)
+    else:
+        sampler = batchIndexSampler(len(dataset), batch_size, shuffle=shuffle, drop_last=drop_last)
+    return DataLoader(dataset, sampler=sampler, batch_size=None)
+
+
+HASH_KINDS = ["hash", "qr"]
+# odd multipliers (all below 2**63, so valid int64) for the multiply-xorshift hash, one per hash function
+HASH_MULTIPLIERS = [0x2545F4914F6CDD1D, 0x5851F42D4C957F2D, 0x14057B7EF767814F, 0x27BB2EE687B0B0FD]
+
+
+def hash_ids(ids, seed, n_buckets):
+    # int64 ids -> [0, n_buckets); int64 multiplication wraps, which is what we want here
+    h = ids * HASH_MULTIPLIERS[seed]
+    h = h ^ (h >> 31)
+    return torch.remainder(h, n_buckets)
+
+
+class compositionalEmbedding(nn.Module):
+    # Fixed-size replacement for nn.Embedding(n_ids, dim) indexed directly by raw ids, so
+    # memory does not grow with the number of users and no global index pass is needed.
+    #   kind="hash": n_hashes hash functions into one table of n_buckets rows, rows summed
+    #   kind="qr":   one hash into [0, n_buckets**2), then the quotient row and the remainder
+    #                row of two n_buckets tables summed (quotient-remainder trick); two ids
+    #                share a vector only if they collide in n_buckets**2
+    # .weight is the first table, so the rankers' init / requires_grad lines keep working;
+    # the other tables are initialised here the same way.
+    def __init__(self, kind, n_buckets, embedding_dim, n_hashes=2, sparse=False):
+        super(compositionalEmbedding, self).__init__()
+        assert kind in HASH_KINDS
+        assert n_hashes <= len(HASH_MULTIPLIERS)
+        self.kind = kind
+        self.n_buckets = n_buckets
+        self.n_hashes = n_hashes
+        n_tables = 1 if kind == "hash" else 2
+        self.tables = nn.ModuleList([nn.Embedding(n_buckets, embedding_dim, sparse=sparse) for _ in range(n_tables)])
+        for t in self.tables:
+            if embedding_dim == 1:
+                torch.nn.init.zeros_(t.weight)
+            else:
+                torch.nn.init.xavier_uniform_(t.weight)
+
+    @property
+    def weight(self):
+        return self.tables[0].weight
+
+    def forward(self, ids):
+        if self.kind == "hash":
+            out = self.tables[0](hash_ids(ids, 0, self.n_buckets))
+            for i in range(1, self.n_hashes):
+                out = out + self.tables[0](hash_ids(ids, i, self.n_buckets))
+            return out
+        h = hash_ids(ids, 0, self.n_buckets * self.n_buckets)
+        return self.tables[0](torch.div(h, self.n_buckets, rounding_mode="floor")) + self.tables[1](torch.remainder(h, self.n_buckets))
+
+
+def require_row_user_tables(model, use):
+    # catalogScorer / quantizedRanker / the TorchScript export address the user table by row
+    # (userIndex, .weight); a hashed table (--user-hash) is indexed by raw userId and .weight is
+    # only its first table, so those paths would silently give wrong scores
+    for name in ("uemb", "user_bias", "user_embedding"):
+        if isinstance(getattr(model, name, None), compositionalEmbedding):
+            raise ValueError(f"{use} does not support hashed user tables (--user-hash); "
+                             f"{name} is a compositionalEmbedding")
+
+
+def user_table(n_uemb, embedding_dim, sparse=False, user_hashing=None, user_storage=None, name="uemb"):
+    # user_hashing: None for the exact n_uemb-row table indexed by userIndex, or
+    # dict(kind="hash"|"qr", buckets=..., n_hashes=...) for a compositionalEmbedding indexed by userId.
+    # user_storage: dict(directory=..., cache_rows=...) keeps the exact table on disk as a
+    # disk_embedding.diskEmbedding in <directory>/<name>.*.npy
+    if user_storage is not None:
+        assert user_hashing is None
+        return diskEmbedding(os.path.join(user_storage["directory"], name), n_uemb, embedding_dim,
+                             user_storage.get("cache_rows", 2**20))
+    if user_hashing is None:
+        return nn.Embedding(n_uemb, embedding_dim=embedding_dim, sparse=sparse)
+    return compositionalEmbedding(user_hashing["kind"], user_hashing["buckets"], embedding_dim,
+                                  user_hashing.get("n_hashes", 2), sparse)
+
+
 class rankerOld(nn.Module):
-    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False):
+    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False, sparse=False, user_hashing=None, user_storage=None):
         super(rankerOld, self).__init__()
         if ispretrained:
-            self.uemb = nn.Embedding.from_pretrained(n_uemb)
-            self.cemb = nn.Embedding.from_pretrained(n_cemb)
+            self.uemb = nn.Embedding.from_pretrained(n_uemb, sparse=sparse)
+            self.cemb = nn.Embedding.from_pretrained(n_cemb, sparse=sparse)
         else:
-            self.uemb = nn.Embedding(n_uemb, embedding_dim=embedding_dim)
-            self.cemb = nn.Embedding(n_cemb, embedding_dim=embedding_dim)
+            self.uemb = user_table(n_uemb, embedding_dim, sparse, user_hashing, user_storage, "uemb")
+            self.cemb = nn.Embedding(n_cemb, embedding_dim=embedding_dim, sparse=sparse)
             torch.nn.init.xavier_uniform_(self.uemb.weight)
             torch.nn.init.xavier_uniform_(self.cemb.weight)
         self.uemb.weight.requires_grad = True
@@ -46,16 +220,21 @@ class rankerOld(nn.Module):
         return torch.sigmoid(dot)
 
 class rankerV0(nn.Module):
-    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False):
+    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False, sparse=False, user_hashing=None, user_storage=None):
         super(rankerV0, self).__init__()
         if ispretrained:
-            self.uemb = nn.Embedding.from_pretrained(n_uemb)
-            self.cemb = nn.Embedding.from_pretrained(n_cemb)
+            self.uemb = nn.Embedding.from_pretrained(n_uemb, sparse=sparse)
+            self.cemb = nn.Embedding.from_pretrained(n_cemb, sparse=sparse)
+            # pretrained csv tables come without biases; load them separately if there are any
+            self.user_bias = nn.Embedding(n_uemb.shape[0], embedding_dim=1, sparse=sparse)
+            self.creator_bias = nn.Embedding(n_cemb.shape[0], embedding_dim=1, sparse=sparse)
+            torch.nn.init.zeros_(self.user_bias.weight)
+            torch.nn.init.zeros_(self.creator_bias.weight)
         else:
-            self.uemb = nn.Embedding(n_uemb, embedding_dim=embedding_dim)
-            self.cemb = nn.Embedding(n_cemb, embedding_dim=embedding_dim)
-            self.user_bias = nn.Embedding(n_uemb, embedding_dim=1)
-            self.creator_bias = nn.Embedding(n_cemb, embedding_dim=1)
+            self.uemb = user_table(n_uemb, embedding_dim, sparse, user_hashing, user_storage, "uemb")
+            self.cemb = nn.Embedding(n_cemb, embedding_dim=embedding_dim, sparse=sparse)
+            self.user_bias = user_table(n_uemb, 1, sparse, user_hashing, user_storage, "user_bias")
+            self.creator_bias = nn.Embedding(n_cemb, embedding_dim=1, sparse=sparse)
             torch.nn.init.xavier_uniform_(self.uemb.weight)
             torch.nn.init.xavier_uniform_(self.cemb.weight)
             torch.nn.init.zeros_(self.user_bias.weight)
@@ -76,13 +255,13 @@ class rankerV0(nn.Module):
         return torch.sigmoid(dot)
 
 class rankerV00(nn.Module):
-    def __init__(self, n_uemb, n_cemb, ispretrained=False):
+    def __init__(self, n_uemb, n_cemb, ispretrained=False, sparse=False, user_hashing=None, user_storage=None):
         super(rankerV00, self).__init__()
         if ispretrained:
             assert False
         else:
-            self.user_bias = nn.Embedding(n_uemb, embedding_dim=1)
-            self.creator_bias = nn.Embedding(n_cemb, embedding_dim=1)
+            self.user_bias = user_table(n_uemb, 1, sparse, user_hashing, user_storage, "user_bias")
+            self.creator_bias = nn.Embedding(n_cemb, embedding_dim=1, sparse=sparse)
             torch.nn.init.zeros_(self.user_bias.weight)
             torch.nn.init.zeros_(self.creator_bias.weight)
         self.user_bias.weight.requires_grad = True
@@ -97,13 +276,13 @@ class rankerV00(nn.Module):
         return torch.sigmoid(dot)
 
 class rankerV1(nn.Module):
-    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False):
+    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False, sparse=False, user_hashing=None, user_storage=None):
         super(rankerV1, self).__init__()
         if ispretrained:
             assert False
         else:
-            self.user_embedding = nn.Embedding(n_uemb, embedding_dim=embedding_dim)
-            self.creator_embedding = nn.Embedding(n_cemb, embedding_dim=embedding_dim)
+            self.user_embedding = user_table(n_uemb, embedding_dim, sparse, user_hashing, user_storage, "user_embedding")
+            self.creator_embedding = nn.Embedding(n_cemb, embedding_dim=embedding_dim, sparse=sparse)
             self.mlp = nn.Sequential(
                 nn.Linear(2 * embedding_dim, 1),
             )
@@ -126,16 +305,58 @@ class rankerV1(nn.Module):
 
         return torch.sigmoid(dot)
 
+class twoTokenAttention(nn.Module):
+    # nn.MultiheadAttention(embed_dim, num_heads, batch_first=True) self-attention over exactly
+    # two tokens (user, creator), in closed form. Same parameters under the same names
+    # (in_proj_weight, in_proj_bias, out_proj), so rankerV2 state dicts load into either.
+    # With two keys the softmax of query i is a sigmoid of its score difference:
+    #   a_i0 = sigmoid(q_i . (k_0 - k_1) / sqrt(head_dim)),   o_i = v_1 + a_i0 * (v_0 - v_1)
+    # per head and token, so there is one dot product per head instead of a 2x2 score matrix,
+    # no softmax and no head transposes; q, k, v of both tokens come from one matmul.
+    def __init__(self, embed_dim, num_heads):
+        super(twoTokenAttention, self).__init__()
+        assert embed_dim % num_heads == 0
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        # the out_proj class and init order of nn.MultiheadAttention: the same seed gives the
+        # same weights, and rankerV2's nn.Linear re-init skips out_proj in both
+        self.out_proj = nn.modules.linear.NonDynamicallyQuantizableLinear(embed_dim, embed_dim)
+        torch.nn.init.xavier_uniform_(self.in_proj_weight)
+        torch.nn.init.zeros_(self.in_proj_bias)
+        torch.nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x0, x1):
+        # x0, x1: [batch, dim] -> [batch, 2, dim], equal to multihead_attention(x, x, x)[0]
+        # for x = torch.stack((x0, x1), dim=1)
+        batch_size = x0.shape[0]
+        qkv = F.linear(torch.stack((x0, x1), dim=1), self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.view(batch_size, 2, 3, self.num_heads, self.head_dim).unbind(2)  # batch, 2, heads, head_dim
+        dk = (k[:, 0] - k[:, 1]).unsqueeze(1)
+        dv = (v[:, 0] - v[:, 1]).unsqueeze(1)
+        a0 = torch.sigmoid(torch.sum(q * dk, dim=-1, keepdim=True) * self.head_dim ** -0.5)  # batch, 2, heads, 1
+        out = v[:, 1].unsqueeze(1) + a0 * dv
+        return self.out_proj(out.reshape(batch_size, 2, self.embed_dim))
+
+
 class rankerV2(nn.Module):
-    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False):
+    # fused_attention=False runs the generic nn.MultiheadAttention; both have the same state dict
+    def __init__(self, n_uemb, n_cemb, embedding_dim=64, ispretrained=False, sparse=False, user_hashing=None,
+                 user_storage=None, fused_attention=True):
         super(rankerV2, self).__init__()
+        self.fused_attention = fused_attention
         if ispretrained:
             assert False
         else:
-            self.user_embedding = nn.Embedding(n_uemb, embedding_dim=embedding_dim)
-            self.creator_embedding = nn.Embedding(n_cemb, embedding_dim=embedding_dim)
+            self.user_embedding = user_table(n_uemb, embedding_dim, sparse, user_hashing, user_storage, "user_embedding")
+            self.creator_embedding = nn.Embedding(n_cemb, embedding_dim=embedding_dim, sparse=sparse)
             # with batch_first=True, expects batch_size, seq_len, emb_dim input shape
-            self.multihead_attention = nn.MultiheadAttention(embedding_dim, num_heads=8, batch_first=True)
+            if fused_attention:
+                self.multihead_attention = twoTokenAttention(embedding_dim, num_heads=8)
+            else:
+                self.multihead_attention = nn.MultiheadAttention(embedding_dim, num_heads=8, batch_first=True)
             self.mlp = nn.Sequential(
                 nn.Linear(2 * embedding_dim, 1),
             )
@@ -153,9 +374,65 @@ class rankerV2(nn.Module):
     def forward(self, x1, x2):
         user_embedding = self.user_embedding(x1) # batch_size, emb_dim
         creator_embedding = self.creator_embedding(x2) # batch_size, emb_dim
-        common_embedding = torch.stack((user_embedding, creator_embedding), dim=1) # batch_size, 2, emb_dim, 2 is seq_length
-        attention_outputs, _ = self.multihead_attention(common_embedding, common_embedding, common_embedding) # batch_size, 2, emb_dim, 2 is seq_length
+        if self.fused_attention:
+            attention_outputs = self.multihead_attention(user_embedding, creator_embedding) # batch_size, 2, emb_dim
+        else:
+            common_embedding = torch.stack((user_embedding, creator_embedding), dim=1) # batch_size, 2, emb_dim, 2 is seq_length
+            attention_outputs, _ = self.multihead_attention(common_embedding, common_embedding, common_embedding) # batch_size, 2, emb_dim, 2 is seq_length
         attention_outputs = torch.flatten(attention_outputs, start_dim = 1) # batch_size, 2 * emb_dim
         out = self.mlp(attention_outputs) # batch_size, 1
         out = torch.flatten(out, start_dim=0) # batch_size,
         return torch.sigmoid(out)
+
+
+MODEL_TYPES = ["rankerOld", "rankerV0", "rankerV00", "rankerV1", "rankerV2"]
+
+
+def create_model(model_type, n_uemb, n_cemb, embedding_dim=64, **kwargs):
+    if model_type == "rankerOld":
+        model = rankerOld(n_uemb, n_cemb, embedding_dim, **kwargs)
+    elif model_type == "rankerV0":
+        model = rankerV0(n_uemb, n_cemb, embedding_dim, **kwargs)
+    elif model_type == "rankerV00":
+        model = rankerV00(n_uemb, n_cemb, **kwargs)
+    elif model_type == "rankerV1":
+        model = rankerV1(n_uemb, n_cemb, embedding_dim, **kwargs)
+    elif model_type == "rankerV2":
+        model = rankerV2(n_uemb, n_cemb, embedding_dim, **kwargs)
+    else:
+        assert False
+    return model.float()
+
+
+def grow_embedding(model, name, n_rows, optimizer=None):
+    # Extends the nn.Embedding `name` of the model to n_rows in place: existing rows are kept,
+    # new rows get the table's initialisation (zeros for the dim-1 bias tables, xavier-uniform
+    # for the embeddings), and the optimizer's references and per-row state are extended too.
+    module = getattr(model, name)
+    old = module.weight
+    n_old, dim = old.shape
+    if n_rows <= n_old:
+        return
+    weight = torch.empty(n_rows, dim, dtype=old.dtype, device=old.device)
+    with torch.no_grad():
+        weight[:n_old] = old
+        if dim == 1:
+            weight[n_old:].zero_()
+        else:
+            bound = (6.0 / (n_rows + dim)) ** 0.5
+            weight[n_old:].uniform_(-bound, bound)
+    module.weight = nn.Parameter(weight, requires_grad=old.requires_grad)
+    module.num_embeddings = n_rows
+    if optimizer is None:
+        return
+    for o in getattr(optimizer, "optimizers", [optimizer]):
+        for group in o.param_groups:
+            group["params"] = [module.weight if p is old else p for p in group["params"]]
+        if old in o.state:
+            state = o.state.pop(old)
+            for key, value in state.items():
+                if torch.is_tensor(value) and value.dim() > 0 and value.shape[0] == n_old:
+                    grown = torch.zeros((n_rows,) + tuple(value.shape[1:]), dtype=value.dtype, device=value.device)
+                    grown[:n_old] = value
+                    state[key] = grown
+            o.state[module.weight] = state
@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+
+from model import require_row_user_tables
+
+QUANT_MODES = ["fp16", "int8"]
+
+
+def quantize_int8_rows(weight):
+    # symmetric per-row int8: row ~= q * scale, scale = max|row| / 127
+    weight = weight.detach().float()
+    scale = weight.abs().amax(dim=1) / 127.0
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    q = torch.round(weight / scale.unsqueeze(1)).clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+class quantizedTable(nn.Module):
+    # read-only embedding table stored as fp16 or per-row int8; lookups dequantize only the
+    # gathered rows, so the float32 table never exists in memory
+    def __init__(self, weight, mode):
+        super(quantizedTable, self).__init__()
+        assert mode in QUANT_MODES
+        self.mode = mode
+        if mode == "fp16":
+            self.register_buffer("weight", weight.detach().half())
+            self.register_buffer("scale", torch.empty(0))
+        else:
+            q, scale = quantize_int8_rows(weight)
+            self.register_buffer("weight", q)
+            self.register_buffer("scale", scale)
+
+    def forward(self, idx):
+        rows = self.weight[idx].float()
+        if self.mode == "int8":
+            rows = rows * self.scale[idx].unsqueeze(-1)
+        return rows
+
+    def nbytes(self):
+        return self.weight.numel() * self.weight.element_size() + self.scale.numel() * self.scale.element_size()
+
+
+class quantizedRanker(nn.Module):
+    # Post-training quantized rankerOld / rankerV0 for serving. Same forward as the float model;
+    # the bias tables (one value per row, where a per-row scale would cost more than it saves)
+    # are stored as fp16 in both modes.
+    def __init__(self, model, mode="int8"):
+        super(quantizedRanker, self).__init__()
+        require_row_user_tables(model, "quantizedRanker")
+        self.mode = mode
+        self.uemb = quantizedTable(model.uemb.weight, mode)
+        self.cemb = quantizedTable(model.cemb.weight, mode)
+        self.has_bias = hasattr(model, "user_bias")
+        if self.has_bias:
+            self.user_bias = quantizedTable(model.user_bias.weight, "fp16")
+            self.creator_bias = quantizedTable(model.creator_bias.weight, "fp16")
+
+    def forward(self, x1, x2):
+        user_embedding = self.uemb(x1)
+        creator_embedding = self.cemb(x2)
+        if self.has_bias:
+            dot = torch.sum(torch.mul(user_embedding, creator_embedding) + self.user_bias(x1) + self.creator_bias(x2), dim=1)
+        else:
+            dot = torch.sum(torch.mul(user_embedding, creator_embedding), dim=1)
+        return torch.sigmoid(dot)
+
+    def nbytes(self):
+        return sum(m.nbytes() for m in self.modules() if isinstance(m, quantizedTable))
+
+
+def float_nbytes(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters())
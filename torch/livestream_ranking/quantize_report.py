@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Quantizes a trained rankerOld/rankerV0 checkpoint to fp16 and int8 tables and reports, per mode,
+# the validation AUC / log loss delta against the float model, the table memory and the scoring
+# latency. With --output the quantized state dicts are saved as <output>_<mode>.pt
+import argparse
+import json
+import time
+
+import torch
+
+from dataset import create_dataset
+from evaluation import predict_tensors
+from inference import load_checkpoint
+from model import columnarDataset
+from quantize import QUANT_MODES, float_nbytes, quantizedRanker
+
+
+def latency_ms(model, tensors, batch_size, repeats):
+    u_ind, c_ind, _ = tensors
+    u_ind, c_ind = u_ind[:batch_size], c_ind[:batch_size]
+    with torch.no_grad():
+        model(u_ind, c_ind)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(u_ind, c_ind)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-type", required=True, choices=["rankerOld", "rankerV0"])
+    parser.add_argument("--checkpoint", default="model_out/model_scratch.pt")
+    parser.add_argument("-i", "--input", default="livestream_ranker_train_data", help="path to local directory with .csv files")
+    parser.add_argument("--latency-batch", type=int, default=32000)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--output", help="prefix for the quantized state dicts")
+    parser.add_argument("--report", help="write the report as json here")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = load_checkpoint(args.model_type, args.checkpoint)
+    main_df = create_dataset(args.input)
+    val_dataset = columnarDataset(main_df[main_df["val"] == "1"])
+    del main_df
+    val_tensors = (val_dataset.user_index, val_dataset.creator_index, val_dataset.label)
+
+    base = predict_tensors(model, val_tensors, batch_size=524280)
+    base_bytes = float_nbytes(model)
+    base_latency = latency_ms(model, val_tensors, args.latency_batch, args.repeats)
+    report = [{"mode": "fp32", "auc": base.roc_auc(), "log-loss": base.log_loss(), "auc_delta": 0.0,
+               "table_mb": base_bytes / 2**20, "latency_ms": base_latency}]
+    for mode in QUANT_MODES:
+        qmodel = quantizedRanker(model, mode)
+        qmodel.eval()
+        m = predict_tensors(qmodel, val_tensors, batch_size=524280)
+        report.append({"mode": mode, "auc": m.roc_auc(), "log-loss": m.log_loss(), "auc_delta": m.roc_auc() - base.roc_auc(),
+                       "table_mb": qmodel.nbytes() / 2**20, "latency_ms": latency_ms(qmodel, val_tensors, args.latency_batch, args.repeats)})
+        if args.output:
+            torch.save(qmodel.state_dict(), f"{args.output}_{mode}.pt")
+
+    print(f"{'mode':6s} {'auc':>8s} {'auc_delta':>10s} {'log-loss':>9s} {'table_mb':>10s} {'mem_ratio':>9s} {'latency_ms':>10s}")
+    for r in report:
+        print(f"{r['mode']:6s} {r['auc']:8.5f} {r['auc_delta']:+10.5f} {r['log-loss']:9.5f} {r['table_mb']:10.1f} "
+              f"{base_bytes / 2**20 / r['table_mb']:9.2f} {r['latency_ms']:10.2f}")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
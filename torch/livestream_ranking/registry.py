@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+
+
+def sorted_search(keys, query):
+    # -> (order, pos, found): query[order] is ascending, keys[pos[i]] == query[order[i]] where
+    # found[i]. The queries are searched in ascending order, so consecutive binary searches
+    # (and the gathers after them) touch neighbouring parts of keys instead of random cache
+    # lines: 4-6x faster than searching in query order once keys outgrow the cache
+    order = np.argsort(query)
+    sorted_query = query[order]
+    pos = np.minimum(np.searchsorted(keys, sorted_query), len(keys) - 1)
+    return order, pos, keys[pos] == sorted_query
+
+
+class idRegistry:
+    # Stable id -> row index assignment: row i belongs to ids[i] forever, new ids are only
+    # ever appended. Unlike groupby().ngroup() a user keeps its row when other users appear,
+    # so embedding tables trained on yesterday's registry stay valid and only need to grow.
+    def __init__(self, ids=None, dtype=np.int64):
+        if ids is None:
+            ids = np.empty(0, dtype=dtype)
+        self.ids = np.array(ids)
+        self._reindex()
+
+    def _reindex(self):
+        self.order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, query):
+        # rows of the query ids, -1 for unknown ids
+        query = np.asarray(query)
+        if len(self.ids) == 0:
+            return np.full(len(query), -1, dtype=np.int64)
+        order, pos, found = sorted_search(self.sorted_ids, query)
+        out = np.empty(len(query), dtype=np.int64)
+        out[order] = np.where(found, self.order[pos], -1)
+        return out
+
+    def add(self, query):
+        # rows of the query ids, appending the unknown ones in order of first appearance
+        query = np.asarray(query)
+        rows = self.lookup(query)
+        missing = rows < 0
+        if missing.any():
+            new_ids, first = np.unique(query[missing], return_index=True)
+            new_ids = new_ids[np.argsort(first)]
+            self.ids = np.concatenate([self.ids, new_ids.astype(self.ids.dtype)])
+            self._reindex()
+            rows[missing] = self.lookup(query[missing])
+        return rows
+
+    def save(self, path):
+        tmp = f"{path}.tmp.{os.getpid()}.npy"
+        np.save(tmp, self.ids)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+
+class idIndex:
+    # Immutable id -> row lookup built once at export time, for serving and bulk scoring.
+    # keys: the ids sorted ascending (int64); rows: the row of keys[i] at rows[i], plus one
+    # trailing entry, the OOV row returned for unknown ids (-1 by default: score_indices gives NaN;
+    # point it at a real row, e.g. a default embedding, to score unknown ids with that row).
+    # A lookup is one vectorized binary search over the sorted queries (sorted_search) plus one
+    # gather, and nothing is built at load time: the two .npy files are memory-mapped by
+    # load(), so opening a 100M-id index reads nothing up front.
+    def __init__(self, keys, rows):
+        self.keys = keys
+        self.rows = rows
+
+    @classmethod
+    def from_ids(cls, ids, oov_row=-1):
+        # ids in row order (row i <-> ids[i]), as stored by embeddings.write_store and idRegistry
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        keys = ids[order]
+        if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+            raise ValueError("ids are not unique")
+        dtype = np.int32 if len(ids) < 2**31 else np.int64
+        rows = np.empty(len(ids) + 1, dtype=dtype)
+        rows[:-1] = order
+        rows[-1] = oov_row
+        return cls(keys, rows)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def oov_row(self):
+        return int(self.rows[-1])
+
+    def lookup(self, query):
+        # rows of the query ids, oov_row for unknown ids
+        query = np.asarray(query)
+        n = len(self.keys)
+        if n == 0:
+            return np.full(len(query), self.oov_row, dtype=self.rows.dtype)
+        order, pos, found = sorted_search(self.keys, query)
+        out = np.empty(len(query), dtype=self.rows.dtype)
+        out[order] = self.rows[np.where(found, pos, n)]
+        return out
+
+    def save(self, directory, name):
+        # <directory>/<name>_index.keys.npy and <name>_index.rows.npy
+        for part, values in (("keys", self.keys), ("rows", self.rows)):
+            path = os.path.join(directory, f"{name}_index.{part}.npy")
+            tmp = f"{path}.tmp.{os.getpid()}.npy"
+            np.save(tmp, np.ascontiguousarray(values))
+            os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode="r"):
+        return cls(*(np.load(os.path.join(directory, f"{name}_index.{part}.npy"), mmap_mode=mmap_mode)
+                     for part in ("keys", "rows")))
+
+    @staticmethod
+    def exists(directory, name):
+        return os.path.exists(os.path.join(directory, f"{name}_index.rows.npy"))
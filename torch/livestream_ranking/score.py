@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Batch scoring of (userId, creatorId) pairs with an export_model.py artifact.
+# Streams every input csv in chunks, maps ids to rows, scores in large batches (torch spreads
+# each batch over --threads cores) and writes one parquet file per input with
+# userId, creatorId, score; score is NaN for ids the model has never seen.
+import argparse
+import os
+import time
+
+import pandas as pd
+import torch
+
+from inference import load_scorer, score_indices
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", required=True, help="output directory of export_model.py")
+    parser.add_argument("-i", "--input", required=True, help="csv file or directory of csv files")
+    parser.add_argument("-o", "--output", required=True, help="directory for the <input name>.parquet score files")
+    parser.add_argument("--user-col", default="userId")
+    parser.add_argument("--creator-col", default="creatorId")
+    parser.add_argument("--batch-size", type=int, default=524288)
+    parser.add_argument("--chunk-rows", type=int, default=4000000, help="rows read from a csv at a time")
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    module, user_registry, creator_registry, meta = load_scorer(args.model_dir)
+    print(f"loaded {meta['model_type']}: {len(user_registry)} users, {len(creator_registry)} creators")
+    if os.path.isdir(args.input):
+        files = [os.path.join(args.input, i) for i in sorted(os.listdir(args.input))]
+    else:
+        files = [args.input]
+    os.makedirs(args.output, exist_ok=True)
+
+    total_pairs = 0
+    score_seconds = 0.0
+    start = time.perf_counter()
+    for path in files:
+        parts = []
+        for chunk in pd.read_csv(path, usecols=[args.user_col, args.creator_col], chunksize=args.chunk_rows):
+            user_ids = chunk[args.user_col].to_numpy()
+            creator_ids = chunk[args.creator_col].to_numpy()
+            t = time.perf_counter()
+            scores = score_indices(module, user_registry.lookup(user_ids), creator_registry.lookup(creator_ids), args.batch_size)
+            score_seconds += time.perf_counter() - t
+            parts.append(pd.DataFrame({args.user_col: user_ids, args.creator_col: creator_ids, "score": scores}))
+            total_pairs += len(chunk)
+        out = pd.concat(parts, ignore_index=True)
+        out.to_parquet(os.path.join(args.output, os.path.splitext(os.path.basename(path))[0] + ".parquet"), index=False)
+        print(f"{path}: {len(out)} pairs, {int(out['score'].isna().sum())} with unknown ids")
+    wall = time.perf_counter() - start
+    print(f"scored {total_pairs} pairs: {total_pairs / wall:.0f} pairs/sec end to end, "
+          f"{total_pairs / max(score_seconds, 1e-9):.0f} pairs/sec lookup+forward")
+
+
+if __name__ == "__main__":
+    main()
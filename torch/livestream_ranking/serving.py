@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from inference import score_indices
+
+
+class scoringServer:
+    # In-process asyncio scoring service for an export_model.py artifact (see inference.load_scorer).
+    # score(userId, creatorIds) queues the request and returns its scores (NaN for unknown ids).
+    # A single batching task coalesces queued requests into one micro-batch until it holds
+    # max_batch_pairs (user, creator) pairs or the oldest request has waited max_wait_ms, then
+    # maps ids to rows and runs one forward on a worker thread; requests arriving meanwhile
+    # queue up for the next batch. max_batch_pairs=1 scores every request on its own.
+    # stats() reports latency percentiles over the last `window` requests and throughput since start().
+    def __init__(self, module, user_registry, creator_registry, max_batch_pairs=65536, max_wait_ms=2.0, window=100000):
+        self.module = module
+        self.user_registry = user_registry
+        self.creator_registry = creator_registry
+        self.max_batch_pairs = max_batch_pairs
+        self.max_wait = max_wait_ms / 1000
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_pairs = collections.deque(maxlen=window)
+        self.counters = {"requests": 0, "pairs": 0, "batches": 0}
+        self.queue = None
+        self.task = None
+        self.executor = None
+        self.started = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.started = time.perf_counter()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        # scores what is already queued, then stops
+        await self.queue.put(None)
+        await self.task
+        self.executor.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def score(self, user_id, creator_ids):
+        arrival = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user_id, np.asarray(creator_ids), future, arrival))
+        scores = await future
+        self.latencies.append(time.perf_counter() - arrival)
+        return scores
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            pairs = len(first[1])
+            # the deadline counts from the oldest request's arrival, not from when the batch opened
+            deadline = loop.time() + self.max_wait - (time.perf_counter() - first[3])
+            while pairs < self.max_batch_pairs:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                pairs += len(item[1])
+            try:
+                scores = await loop.run_in_executor(self.executor, self._score_batch, batch)
+            except Exception as e:
+                # fails this batch's requests only; the batcher keeps serving
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.counters["requests"] += len(batch)
+            self.counters["pairs"] += pairs
+            self.counters["batches"] += 1
+            self.batch_pairs.append(pairs)
+            start = 0
+            for _, creator_ids, future, _ in batch:
+                # a client that gave up (e.g. asyncio.wait_for timeout) has a cancelled future
+                if not future.done():
+                    future.set_result(scores[start:start + len(creator_ids)])
+                start += len(creator_ids)
+
+    def _score_batch(self, batch):
+        lengths = [len(creator_ids) for _, creator_ids, _, _ in batch]
+        user_ids = np.repeat(np.asarray([user_id for user_id, _, _, _ in batch]), lengths)
+        creator_ids = np.concatenate([creator_ids for _, creator_ids, _, _ in batch])
+        u_ind = self.user_registry.lookup(user_ids)
+        c_ind = self.creator_registry.lookup(creator_ids)
+        return score_indices(self.module, u_ind, c_ind, batch_size=max(self.max_batch_pairs, len(u_ind)))
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = np.asarray(self.latencies) * 1000
+        out = dict(self.counters, requests_per_sec=self.counters["requests"] / elapsed,
+                   pairs_per_sec=self.counters["pairs"] / elapsed,
+                   mean_batch_pairs=float(np.mean(self.batch_pairs)) if self.batch_pairs else 0.0)
+        for p in (50, 99):
+            out[f"latency_ms_p{p}"] = float(np.percentile(latencies, p)) if len(latencies) else float("nan")
+        return out
@@ -0,0 +1,97 @@
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from disk_embedding import diskEmbedding, diskTableOptimizer
+
+OPTIMIZERS = ["adam", "sparse-adam", "rowwise-adagrad"]
+
+
+class rowWiseAdagrad(optim.Optimizer):
+    # Adagrad with one accumulator per embedding row (mean of the squared row gradient)
+    # instead of one per element: optimizer state is n_rows floats, 1/embedding_dim of
+    # Adagrad's and 1/(2*embedding_dim) of Adam's. With sparse gradients only the rows
+    # present in the batch are read or written.
+    def __init__(self, params, lr=0.01, eps=1e-10, initial_accumulator_value=0.0):
+        defaults = dict(lr=lr, eps=eps, initial_accumulator_value=initial_accumulator_value)
+        super(rowWiseAdagrad, self).__init__(params, defaults)
+        for group in self.param_groups:
+            for p in group["params"]:
+                self.state[p]["sum"] = torch.full((p.shape[0],), initial_accumulator_value, dtype=p.dtype, device=p.device)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                state_sum = self.state[p]["sum"]
+                if p.grad.is_sparse:
+                    grad = p.grad.coalesce()
+                    rows = grad._indices()[0]
+                    values = grad._values()
+                    state_sum.index_add_(0, rows, values.pow(2).mean(dim=1))
+                    std = state_sum[rows].sqrt_().add_(group["eps"])
+                    p.index_add_(0, rows, values / std.unsqueeze(1), alpha=-group["lr"])
+                else:
+                    grad = p.grad
+                    state_sum.add_(grad.pow(2).mean(dim=1))
+                    std = state_sum.sqrt().add_(group["eps"])
+                    p.addcdiv_(grad, std.unsqueeze(1), value=-group["lr"])
+        return loss
+
+
+class optimizerGroup:
+    # steps several optimizers as one (sparse embedding tables + dense layers)
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self, set_to_none=True):
+        for o in self.optimizers:
+            o.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for o in self.optimizers:
+            o.step()
+
+    def state_dict(self):
+        return [o.state_dict() for o in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for o, s in zip(self.optimizers, state_dicts):
+            o.load_state_dict(s)
+
+
+def split_parameters(model):
+    # weights of nn.Embedding(sparse=True) modules vs everything else
+    sparse = [m.weight for m in model.modules() if isinstance(m, nn.Embedding) and m.sparse and m.weight.requires_grad]
+    sparse_ids = {id(p) for p in sparse}
+    dense = [p for p in model.parameters() if p.requires_grad and id(p) not in sparse_ids]
+    return sparse, dense
+
+
+def create_optimizer(model, name, lr):
+    # "adam" is the original dense path; the others expect the model built with sparse=True.
+    # diskEmbedding tables have no parameters and always update with their own row-wise
+    # Adagrad (the state is in the table files), whatever the name
+    assert name in OPTIMIZERS
+    disk_tables = [m for m in model.modules() if isinstance(m, diskEmbedding)]
+    if name == "adam":
+        if not disk_tables:
+            return optim.Adam(model.parameters(), lr=lr)
+        return optimizerGroup([optim.Adam(model.parameters(), lr=lr), diskTableOptimizer(disk_tables, lr)])
+    sparse, dense = split_parameters(model)
+    assert len(sparse) > 0, "build the model with sparse=True"
+    if name == "sparse-adam":
+        optimizers = [optim.SparseAdam(sparse, lr=lr)]
+    else:
+        optimizers = [rowWiseAdagrad(sparse, lr=lr)]
+    if len(dense) > 0:
+        optimizers.append(optim.Adam(dense, lr=lr))
+    if disk_tables:
+        optimizers.append(diskTableOptimizer(disk_tables, lr))
+    return optimizerGroup(optimizers)
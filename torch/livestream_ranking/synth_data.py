@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Writes synthetic interaction csvs in the layout of the livestream_ranker_train_data bigquery
+# extract (livestreamId, hostId, memberId, interaction_date, total_timespent,
+# livestream_exit_time, label), so dataset.create_dataset and the trainers can be run and
+# benchmarked without the private data.
+# Users and creators are drawn with Zipfian popularity (rank k has weight 1 / k**a) and get
+# sparse random int64 ids; watch time depends on a low-rank user x creator affinity, so the
+# label is learnable. Dates cover --days days ending at dataset.VAL_DATE.
+import argparse
+import datetime
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from dataset import VAL_DATE
+
+AFFINITY_RANK = 4
+
+
+def zipf_cdf(n, a):
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** a
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def population(n, a, id_offset, rng):
+    # (popularity cdf over ranks, id of each rank, affinity factors of each rank)
+    ids = rng.choice(n * 4, size=n, replace=False).astype(np.int64) * 7 + id_offset
+    factors = rng.standard_normal((n, AFFINITY_RANK)).astype(np.float32)
+    return zipf_cdf(n, a), ids, factors
+
+
+def write_file(file_index, args, users, creators, dates):
+    rng = np.random.default_rng([args.seed, file_index])
+    n = args.rows // args.files + (1 if file_index < args.rows % args.files else 0)
+    user_cdf, user_ids, user_f = users
+    creator_cdf, creator_ids, creator_f = creators
+    u = np.minimum(np.searchsorted(user_cdf, rng.random(n)), len(user_ids) - 1)
+    c = np.minimum(np.searchsorted(creator_cdf, rng.random(n)), len(creator_ids) - 1)
+    affinity = np.einsum("ij,ij->i", user_f[u], creator_f[c]) / AFFINITY_RANK ** 0.5
+    # minutes watched: lognormal, shifted by the affinity; label is watched >= 1 minute (as in dataset.read_file)
+    total_timespent = np.exp(rng.normal(args.timespent_mu + affinity, 1.0))
+    day = rng.integers(0, len(dates), n)
+    exit_time = dates["epoch"].to_numpy()[day] + rng.integers(0, 86400, n)
+    df = pd.DataFrame({
+        "livestreamId": rng.integers(0, 10**9, n),
+        "hostId": creator_ids[c],
+        "memberId": user_ids[u],
+        "interaction_date": dates["date"].to_numpy()[day],
+        "total_timespent": np.round(total_timespent, 4),
+        "livestream_exit_time": exit_time,
+        "label": (total_timespent * 60 >= 60).astype(np.int8),
+    })
+    path = os.path.join(args.output, f"part-{file_index:05d}.csv")
+    df.to_csv(path, index=False)
+    return path, n
+
+
+def generate(args):
+    os.makedirs(args.output, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    users = population(args.users, args.user_zipf, 10**9, rng)
+    creators = population(args.creators, args.creator_zipf, 10**6, rng)
+    end = datetime.date.fromisoformat(args.end_date)
+    days = [end - datetime.timedelta(days=i) for i in range(args.days)][::-1]
+    dates = pd.DataFrame({
+        "date": [d.isoformat() for d in days],
+        "epoch": [int(datetime.datetime(d.year, d.month, d.day, tzinfo=datetime.timezone.utc).timestamp()) for d in days],
+    })
+    with Pool(args.workers) as p:
+        written = p.map(partial(write_file, args=args, users=users, creators=creators, dates=dates), range(args.files))
+    return written
+
+
+def add_arguments(parser):
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--users", type=int, default=2000000)
+    parser.add_argument("--creators", type=int, default=40000)
+    parser.add_argument("--user-zipf", type=float, default=1.05, help="zipf exponent of user activity")
+    parser.add_argument("--creator-zipf", type=float, default=1.2, help="zipf exponent of creator popularity")
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--end-date", default=VAL_DATE)
+    parser.add_argument("--timespent-mu", type=float, default=-0.3, help="log-minutes mean, sets the positive rate")
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="synthetic_train_data")
+    add_arguments(parser)
+    args = parser.parse_args()
+    written = generate(args)
+    print(f"wrote {sum(n for _, n in written)} rows in {len(written)} files to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import torch
+
+from model import require_row_user_tables
+
+
+class catalogScorer:
+    # Top-K creators per user over the whole creator table of a rankerV0 / rankerOld.
+    #
+    # rankerV0 scores sigmoid(sum_d(u_d * c_d + ub + cb)) = sigmoid(u.c + dim * (ub + cb)), so the
+    # catalog score is one GEMM of the user batch against the creator table plus a per-creator
+    # bias row; the user bias shifts all of a user's scores equally and is only added at the end.
+    # Creators are processed in chunks of chunk_size rows (chunk_size * dim * 4 bytes should fit
+    # in cache) and a running top-K is merged per chunk, so the users x creators matrix is never
+    # materialized.
+    def __init__(self, model, allowed_creators=None, chunk_size=4096):
+        require_row_user_tables(model, "catalogScorer")
+        self.uemb = model.uemb.weight.detach()
+        self.cemb_all = model.cemb.weight.detach()
+        dim = self.uemb.shape[1]
+        if hasattr(model, "user_bias"):
+            self.user_bias = model.user_bias.weight.detach()[:, 0] * dim
+            self.creator_bias_all = model.creator_bias.weight.detach()[:, 0] * dim
+        else:
+            self.user_bias = None
+            self.creator_bias_all = None
+        self.chunk_size = chunk_size
+        self.set_allowed(allowed_creators)
+
+    def set_allowed(self, allowed_creators=None):
+        # restrict the catalog to these creator rows (e.g. currently live streams); None = all.
+        # the allowed rows are gathered once into a contiguous table
+        if allowed_creators is None:
+            self.creator_rows = torch.arange(self.cemb_all.shape[0])
+            self.cemb = self.cemb_all
+            self.creator_bias = self.creator_bias_all
+        else:
+            self.creator_rows = torch.as_tensor(allowed_creators, dtype=torch.int64)
+            self.cemb = self.cemb_all[self.creator_rows].contiguous()
+            self.creator_bias = None if self.creator_bias_all is None else self.creator_bias_all[self.creator_rows]
+
+    @torch.no_grad()
+    def topk(self, user_index, k=100):
+        # -> (scores [n_users, k] after sigmoid, creator rows [n_users, k]), best first
+        user_index = torch.as_tensor(user_index, dtype=torch.int64)
+        u = self.uemb[user_index]
+        n_users = len(user_index)
+        k = min(k, self.cemb.shape[0])
+        best = torch.full((n_users, k), float("-inf"))
+        best_pos = torch.zeros((n_users, k), dtype=torch.int64)
+        for start in range(0, self.cemb.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, self.cemb.shape[0])
+            logits = u @ self.cemb[start:end].T
+            if self.creator_bias is not None:
+                logits += self.creator_bias[start:end]
+            merged = torch.cat([best, logits], dim=1)
+            merged_pos = torch.cat([best_pos, torch.arange(start, end).expand(n_users, -1)], dim=1)
+            best, idx = torch.topk(merged, k, dim=1)
+            best_pos = torch.gather(merged_pos, 1, idx)
+        if self.user_bias is not None:
+            best += self.user_bias[user_index].unsqueeze(1)
+        return torch.sigmoid(best), self.creator_rows[best_pos]
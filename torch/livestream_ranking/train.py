@@ -1,103 +1,190 @@
 #!/usr/bin/env python
 import argparse
 import torch.nn as nn
-import torch.optim as optim
 
-from torch.utils.data import DataLoader
 import torch
-from model import catDataset, rankerV0, rankerV1, rankerV00, rankerV2, rankerOld
+from model import columnarDataset, columnar_dataloader, create_model, MODEL_TYPES, HASH_KINDS
 
 import pandas as pd
-import numpy as np
 import os
 
-import datetime
-from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
 
-from dataset import create_dataset
+from dataset import create_dataset, prepare_cache, load_cache, load_id_maps, id_maps, MAX_USER_INDEX
+from evaluation import asyncEvaluator, sample_tensors
+from checkpoint import checkpointWriter, latest_checkpoint, load_training_state
+from instrumentation import stepInstrumentation, print_summary
+from fast_step import make_forward_loss
+from disk_embedding import diskEmbedding
+from metrics import binnedMetrics
+from sparse_optim import create_optimizer, OPTIMIZERS
+from embeddings import export_embeddings, model_tables, write_csv
+from distributed import init_process_group, min_across_ranks, average_gradients, all_gather_objects
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import time
 
 data_directory = "livestream_ranker_train_data/"
 model_update = "model_out/"
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model-type", type=str, required=True, choices=["rankerOld", "rankerV0", "rankerV00", "rankerV1", "rankerV2"])
+    parser.add_argument("--model-type", type=str, required=True, choices=MODEL_TYPES)
     parser.add_argument("-i", "--input", default="livestream_ranker_train_data", help="path to local directory with .csv files")
     # add another int option "epochs"
     parser.add_argument("--epochs", type=int, default=5, help="number of epochs")
     parser.add_argument("--embedding-dim", type=int, help="Embedding lookup dimension")
+    parser.add_argument("--dataset-cache", type=str, help="directory for the preprocessed dataset cache, default <input>_cache")
+    parser.add_argument("--no-dataset-cache", action="store_true", help="always re-parse the csv files")
+    parser.add_argument("--optimizer", default="adam", choices=OPTIMIZERS,
+                        help="sparse-adam / rowwise-adagrad train the embedding tables with sparse gradients, updating only the rows in the batch")
+    parser.add_argument("--val-sample-rows", type=int, default=10 * 524280, help="size of the fixed validation subsample evaluated every 100 steps")
+    parser.add_argument("--world-size", type=int, default=1,
+                        help="number of local data-parallel training processes (gloo); each trains on a disjoint shard with batch 32000/world-size")
+    parser.add_argument("--threads", type=int, default=32, help="torch threads, split evenly between the processes")
+    parser.add_argument("--locality-window", type=int, default=0,
+                        help="group the rows of every N shuffled batches by user/creator row for locality of the embedding "
+                             "gathers (model.localityBatchSampler); 0 = plain full shuffle")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv-export", action="store_true", help="also write the old user_emb_*/creator_emb_* csv files (rankerOld/rankerV0 only)")
+    parser.add_argument("--user-hash", choices=HASH_KINDS,
+                        help="hashed user tables indexed by raw userId instead of one row per user: "
+                             "hash = sum of --user-hashes hashed rows, qr = quotient-remainder pair of tables")
+    parser.add_argument("--user-buckets", type=int, default=2**20, help="rows per hashed user table")
+    parser.add_argument("--user-hashes", type=int, default=2, help="number of hash functions for --user-hash hash")
+    parser.add_argument("--user-disk-dir",
+                        help="keep the user tables in memory-mapped files in this directory with an in-memory row cache, "
+                             "and drop the MAX_USER_INDEX user cutoff. The best-model save and the export hold the "
+                             "tables; training checkpoints are not written (no --resume)")
+    parser.add_argument("--user-cache-rows", type=int, default=2**22, help="cached rows per user table with --user-disk-dir")
+    parser.add_argument("--checkpoint-every", type=int, default=1000,
+                        help="steps between training checkpoints (model, optimizer, position), 0 = only at epoch ends")
+    parser.add_argument("--keep-checkpoints", type=int, default=3, help="number of training checkpoints kept on disk")
+    parser.add_argument("--resume", action="store_true", help="continue from the newest checkpoint in model_out/checkpoints")
+    parser.add_argument("--bf16", action="store_true",
+                        help="forward/backward under cpu bfloat16 autocast; weights and optimizer state stay float32")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the forward + loss (torch >= 2.0)")
+    parser.add_argument("--instrument", help="write per-step phase timings (data/forward/backward/allreduce/optimizer/other), "
+                                             "samples/sec, rss and cpu utilization to this jsonl file (.rank<r> appended per rank)")
+    parser.add_argument("--profile-steps", help="START:END, capture a torch.profiler trace of these steps (counted from the "
+                                                "start of the run); needs --instrument")
+    parser.add_argument("--profile-trace", default=f"{model_update}trace.json", help="chrome trace output of --profile-steps")
     print("Torch cuda device cound: ", torch.cuda.device_count())
     args = parser.parse_args()
+    if args.profile_steps and not args.instrument:
+        parser.error("--profile-steps needs --instrument")
+    if args.user_disk_dir and (args.world_size > 1 or args.resume or args.user_hash):
+        parser.error("--user-disk-dir does not work with --world-size > 1, --resume or --user-hash")
+    if args.compile and args.optimizer != "adam":
+        parser.error("--compile also compiles the backward, which cannot produce sparse gradients: use --optimizer adam")
+    if args.world_size > 1 and args.optimizer == "adam":
+        parser.error("--world-size > 1 needs sparse embedding gradients: --optimizer sparse-adam or rowwise-adagrad")
+
+    if args.world_size > 1:
+        mp.spawn(train, args=(args,), nprocs=args.world_size)
+    else:
+        train(0, args)
+
+
+def train(rank, args):
+    is_main = rank == 0
 
     def predict(model, dataloader, feature_x=False, is_sample=False):
-        pred_lis = []
-        label_lis = []
-        loss_lis = []
+        metrics = binnedMetrics()
         step = 0
         for batch in dataloader:
             if feature_x:
                 u_ind, c_ind, features, labels = batch[0].to(device), batch[1].to(device), batch[2].to(device), batch[3].to(
                     device)
                 preds = model(u_ind, c_ind, features)
-                loss = CELoss(preds, labels)
                 #             print(preds.shape, labels.shape)
                 preds = torch.nn.functional.softmax(preds, dim=1)[:, 1]
             else:
                 u_ind, c_ind, labels = batch[0].to(device), batch[1].to(device), batch[2].to(device)
                 preds = model(u_ind, c_ind)
-                loss = CELoss(preds, labels)
 
-            # print(loss.item())
-            preds = preds.detach().cpu().numpy()
-
-            labels = labels.detach().cpu().numpy()
-            # pred_cls = np.argmax(preds, axis=1)
-            pred_lis.extend(preds)
-            label_lis.extend(labels)
-            loss_lis.append(loss.cpu().item())
+            metrics.update(preds.detach().cpu().numpy(), labels.detach().cpu().numpy())
             step += 1
             if is_sample and step == 10:
                 break
 
-        return np.array(pred_lis), np.array(label_lis), np.mean(loss_lis)
+        return metrics
 
     # train_data, val_data = train_test_split(main_df, test_size=.2, stratify=main_df['label'])
-    main_df = create_dataset(args.input)
-    train_dataset = catDataset(main_df[main_df["val"] == "0"])
-    train_dataloader = DataLoader(train_dataset, batch_size= 32000, shuffle=True)
-    val_dataset = catDataset(main_df[main_df["val"]=="1"])
-    val_dataloader = DataLoader(val_dataset, batch_size= 524280, shuffle=True)
-    torch.set_num_threads(32)
+    # hashed user tables are indexed by the raw userId, so the dataset keeps it as userIndex
+    user_hashing = None
+    user_index = "ngroup"
+    if args.user_hash:
+        user_hashing = dict(kind=args.user_hash, buckets=args.user_buckets, n_hashes=args.user_hashes)
+        user_index = "id"
+    # user tables on disk are not limited by RAM, so all users are kept
+    user_storage = None
+    max_user_index = MAX_USER_INDEX
+    if args.user_disk_dir:
+        user_storage = dict(directory=args.user_disk_dir, cache_rows=args.user_cache_rows)
+        max_user_index = None
+    if args.world_size > 1:
+        init_process_group(rank, args.world_size)
+        # rank 0 builds the cache once; every rank then mmaps it and keeps only its train shard
+        if is_main:
+            prepare_cache(args.input, cache_dir=args.dataset_cache, user_index=user_index)
+        dist.barrier()
+        cache_dir, key = prepare_cache(args.input, cache_dir=args.dataset_cache, user_index=user_index)
+        main_df = load_cache(cache_dir, key, shard=(rank, args.world_size), user_index=user_index)
+        user_ids, creator_ids = load_id_maps(cache_dir, key)
+    else:
+        main_df = create_dataset(args.input, cache_dir=args.dataset_cache, use_cache=not args.no_dataset_cache,
+                                 user_index=user_index, max_user_index=max_user_index)
+        user_ids, creator_ids = id_maps(main_df, user_index)
+    train_dataset = columnarDataset(main_df[main_df["val"] == "0"])
+    train_dataloader = columnar_dataloader(train_dataset, batch_size= 32000 // args.world_size, shuffle=True,
+                                           locality_window=args.locality_window)
+    # all ranks must run the same number of steps, shards can differ by one batch
+    steps_per_epoch = len(train_dataloader)
+    if args.world_size > 1:
+        steps_per_epoch = min_across_ranks(steps_per_epoch)
+    val_dataset = columnarDataset(main_df[main_df["val"]=="1"])
+    val_dataloader = columnar_dataloader(val_dataset, batch_size= 524280, shuffle=True)
+    if is_main:
+        val_sample = sample_tensors(val_dataset, args.val_sample_rows)
+    torch.set_num_threads(max(1, args.threads // args.world_size))
 
     device = torch.device("cpu")
     learning_rate =.01
     print("args.model_type: ", args.model_type)
-    if args.model_type == "rankerOld":
-        model = rankerOld(max(main_df['userIndex'])+1,max(main_df['creatorIndex'])+1, args.embedding_dim).float()
-    elif args.model_type == "rankerV0":
-        model = rankerV0(max(main_df['userIndex'])+1,max(main_df['creatorIndex'])+1, args.embedding_dim).float()
-    elif args.model_type == "rankerV00":
-        model = rankerV00(max(main_df['userIndex'])+1,max(main_df['creatorIndex'])+1).float()
-    elif args.model_type == "rankerV1":
-        model = rankerV1(max(main_df['userIndex'])+1,max(main_df['creatorIndex'])+1, args.embedding_dim).float()
-    elif args.model_type == "rankerV2":
-        model = rankerV2(max(main_df['userIndex'])+1,max(main_df['creatorIndex'])+1, args.embedding_dim).float()
-    else:
-        assert False
+    # same seed on every rank, so the replicas start identical
+    torch.manual_seed(args.seed)
+    model = create_model(args.model_type, len(user_ids), len(creator_ids), args.embedding_dim,
+                         sparse=args.optimizer != "adam", user_hashing=user_hashing, user_storage=user_storage)
     CELoss = nn.BCELoss()
     model.to(device)
-    optimizer = optim.Adam(model.parameters(),lr = learning_rate)
+    optimizer = create_optimizer(model, args.optimizer, learning_rate)
+    forward_loss = make_forward_loss(model, CELoss, bf16=args.bf16, compile=args.compile)
     print("model will run on: {}".format(device))
 
+    # training checkpoints hold model + optimizer state, the position (epoch, steps done) and
+    # the rng states of every rank, so a resumed run replays the same batches
+    checkpoint_dir = f"{model_update}checkpoints"
+    resume_state = None
+    start_epoch, start_step = 0, 0
+    if args.resume:
+        resume_path = latest_checkpoint(checkpoint_dir)
+        if resume_path is None:
+            print(f"no checkpoint in {checkpoint_dir}, starting from scratch")
+        else:
+            resume_state = load_training_state(resume_path)
+            model.load_state_dict(resume_state["model"])
+            optimizer.load_state_dict(resume_state["optimizer"])
+            start_epoch, start_step = resume_state["epoch"], resume_state["step"]
+            if start_step >= steps_per_epoch:
+                start_epoch, start_step = start_epoch + 1, 0
+            print(f"resuming from {resume_path}: epoch {start_epoch} step {start_step}")
+
 
-    is_early = True
-    feat_scores = []
     train_loss = []
     val_loss = []
     loss_lis_train = []
     val_roc=[]
-    min_loss = 9999999
 
 
     # def weights_init(m):
@@ -109,86 +196,165 @@ def main():
     loss_list_name = "loss_list_scratch"
     train_losses = []
     eval_aucs = []
-    for epoch in range(args.epochs):
+    # validation on the fixed subsample runs on a weight snapshot in the background;
+    # it also saves the snapshot whenever its loss improves
+    # in data-parallel mode only rank 0 evaluates, checkpoints and exports; the replicas stay identical
+    if is_main:
+        evaluator = asyncEvaluator(model, val_sample, batch_size=524280, checkpoint_path=f"{model_update}{model_name}.pt")
+        writer = checkpointWriter(checkpoint_dir, keep=args.keep_checkpoints)
+        # one "epoch step loss" line per train step, appended; a resumed run first cuts off
+        # the lines written after its checkpoint
+        loss_log_path = f"{loss_list_name}.txt"
+        if resume_state is not None and os.path.exists(loss_log_path):
+            os.truncate(loss_log_path, resume_state["loss_log_offset"])
+            loss_log = open(loss_log_path, "a")
+        else:
+            loss_log = open(loss_log_path, "w")
+        if resume_state is not None:
+            evaluator.min_loss = resume_state["min_loss"]
+
+    instrument_path = args.instrument
+    profile_steps = None
+    trace_path = args.profile_trace
+    if args.profile_steps:
+        profile_steps = tuple(int(i) for i in args.profile_steps.split(":"))
+    if args.world_size > 1 and instrument_path:
+        instrument_path = f"{instrument_path}.rank{rank}"
+        trace_path = f"{trace_path}.rank{rank}"
+    instr = stepInstrumentation(instrument_path, profile_steps, trace_path)
+
+    def rng_states():
+        # the ranks' global rng states differ (different shards, rank 0 also samples for validation)
+        if args.world_size > 1:
+            return all_gather_objects(torch.get_rng_state())
+        return [torch.get_rng_state()]
+
+    def save_checkpoint(epoch, step, total_loss, epoch_rng_states):
+        # called by every rank at the same step; only rank 0 writes. Disk user tables would be
+        # copied into memory by the snapshot, and --resume does not support them anyway
+        if args.user_disk_dir:
+            return
+        states = rng_states()
+        if not is_main:
+            return
+        loss_log.flush()
+        writer.checkpoint(model, optimizer, epoch, step, total_loss=total_loss, epoch_rng_states=epoch_rng_states,
+                          rng_states=states, min_loss=float(evaluator.min_loss), loss_log_offset=loss_log.tell())
+
+    def log_val_results(results):
+        for (val_epoch, val_step), loss, met in results:
+            val_loss.append(loss)
+            print(f"val roc_auc (epoch {val_epoch} step {val_step}): ", met)
+            eval_aucs.append(met)
+            val_roc.append(met)
+
+    for epoch in range(start_epoch, args.epochs):
         print(epoch)
         total_loss = 0
         step = 0
         model.train()
-        c = 0
+        # resuming mid-epoch: restore the rng this epoch's shuffle was drawn from, skip the
+        # steps already done, then restore the rng as it was at the checkpoint
+        resuming = resume_state is not None and epoch == start_epoch
+        if resuming:
+            total_loss = resume_state["total_loss"] if start_step > 0 else 0
+            torch.set_rng_state(resume_state["epoch_rng_states" if start_step > 0 else "rng_states"][rank])
+        epoch_rng_states = rng_states()
+        first_step = start_step if resuming else 0
+        epoch_start = time.perf_counter()
+        instr.pause()
         for batch in train_dataloader:
+            if step == steps_per_epoch:
+                break
+            if step < first_step:
+                step += 1
+                if step == first_step:
+                    torch.set_rng_state(resume_state["rng_states"][rank])
+                continue
+            instr.begin_step(epoch, step)
             model.zero_grad()
 
             u_ind, c_ind, labels = batch[0].to(device), batch[1].to(device), batch[2].to(device).float()
-            preds = model(u_ind, c_ind)
-
-            loss = CELoss(preds, labels)
+            loss = forward_loss(u_ind, c_ind, labels)
+            instr.mark("forward")
 
             # backward pass to calculate the gradients
             loss.backward()
+            instr.mark("backward")
+            if args.world_size > 1:
+                average_gradients(model)
+                instr.mark("allreduce")
 
             # update parameters
             optimizer.step()
+            instr.mark("optimizer")
 
             # torch.cuda.empty_cache()
             # add on to the total loss
             loss_item = loss.item()
             loss_lis_train.append(loss_item)
             total_loss += loss_item
+            if is_main:
+                loss_log.write(f"{epoch} {step} {loss_item:.6f}\n")
 
             # progress update after every 100 batches.
-            if step % 100 == 0 and not step == 0:
+            if step % 100 == 0 and not step == 0 and is_main:
                 print("train loss: ", total_loss / step)
                 train_losses.append(total_loss / step)
-                torch.cuda.empty_cache()
-                prediction, true, _ = predict(model, val_dataloader, is_sample=True)
-                val_loss.append(_)
-                met = roc_auc_score(true, prediction)
-                print("val roc_auc: ", met)
-                eval_aucs.append(met)
-                val_roc.append(met)
-                if _ < min_loss:
-                    min_loss = _
-                    torch.save(model.state_dict(), f"{model_update}{model_name}.pt")
+                log_val_results(evaluator.poll())
+                evaluator.submit(model, (epoch, step))
                 # if epoch >= 3 and is_early :
                 #     if val_loss[-1] > val_loss[-2] and val_loss[-2] > val_loss[-3] and val_loss[-3] > val_loss[-4]:
                 #         print("stopping training")
                 #         break
 
             step += 1
-        f = open(f"{loss_list_name}.txt", "w")
-        f.write(str(loss_lis_train))
-        f.close()
+            if args.checkpoint_every and step % args.checkpoint_every == 0 and step < steps_per_epoch:
+                save_checkpoint(epoch, step, total_loss, epoch_rng_states)
+            # logging, evaluator and checkpoint snapshots
+            instr.mark("other")
+            instr.end_step(len(labels))
+        if not is_main:
+            save_checkpoint(epoch, step, total_loss, epoch_rng_states)
+            continue
+        epoch_rows = (step - first_step) * train_dataloader.sampler.batch_size * args.world_size
+        print(f"train samples/sec: {epoch_rows / (time.perf_counter() - epoch_start):.0f}")
+        for name, module in model.named_modules():
+            if isinstance(module, diskEmbedding):
+                print(f"{name} cache: {module.cache_stats()}")
         train_loss.append(total_loss / step)
         print("train loss: ", total_loss / step)
         train_losses.append(total_loss / step)
+        log_val_results(evaluator.wait())
         model.eval()
-        prediction, true, _ = predict(model, val_dataloader)
+        val_metrics = predict(model, val_dataloader)
+        _ = val_metrics.log_loss()
 
-        if _ < min_loss:
-            min_loss = _
-            torch.save(model.state_dict(), model_name)
+        if _ < evaluator.min_loss:
+            evaluator.min_loss = _
+            evaluator.save(model)
 
-        met = roc_auc_score(true, prediction)
-        print("val roc_auc: ", met)
+        met = val_metrics.roc_auc()
+        print("val metrics: ", val_metrics.result())
         eval_aucs.append(met)
-    
+        save_checkpoint(epoch, step, total_loss, epoch_rng_states)
+
+    step_summary = instr.close()
+    if step_summary is not None:
+        print_summary(step_summary, f"step timings ({instrument_path}):")
+    if not is_main:
+        return
+    log_val_results(evaluator.close())
+    writer.close()
+    loss_log.close()
     print("Train losses history: ", ",".join(list(map(lambda x: "{:.3f}".format(x), train_losses))))
     print("Eval aucs history: ", ",".join(list(map(lambda x: "{:.3f}".format(x), eval_aucs))))
 
-    dt_time = datetime.datetime.now()
-    u_dict = main_df[['userIndex','userId']].drop_duplicates('userId').set_index('userIndex', drop=True)
-    u_dict.sort_index(inplace=True)
-    u_dict['time'] = dt_time
-    u_dict['model_name'] = "rankerV0"
-    u_dict['uemb'] = model.uemb.weight.data.numpy().tolist()
-    u_dict.to_csv(f"{model_update}user_emb_{model_name}.csv", index=False)
-
-    c_dict = main_df[['creatorIndex','creatorId']].drop_duplicates('creatorId').set_index('creatorIndex', drop=True)
-    c_dict.sort_index(inplace=True)
-    c_dict['time'] = dt_time
-    c_dict['model_name'] = "rankerV0"
-    c_dict['cemb'] = model.cemb.weight.data.numpy().tolist()
-    c_dict.to_csv(f"{model_update}creator_emb_{model_name}.csv", index=False)
+    export_embeddings(f"{model_update}emb_{model_name}", model, user_ids, creator_ids, args.model_type)
+    if args.csv_export:
+        tables = model_tables(model, user_ids)
+        write_csv(f"{model_update}user_emb_{model_name}.csv", user_ids, 'userId', tables['uemb'], 'uemb', args.model_type)
+        write_csv(f"{model_update}creator_emb_{model_name}.csv", creator_ids, 'creatorId', tables['cemb'], 'cemb', args.model_type)
 
     #torch.save(model.state_dict(), f"{model_update}{model_name}_last_step.pt")
 